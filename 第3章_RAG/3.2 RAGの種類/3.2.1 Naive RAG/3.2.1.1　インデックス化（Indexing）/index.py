@@ -1,13 +1,25 @@
 import os
+import asyncio
+import hashlib
+import itertools
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.rest import HttpRequest
 from azure.search.documents.indexes.models import (
-    SearchIndex, SimpleField, SearchFieldDataType, SearchableField, SearchField, VectorSearch, HnswAlgorithmConfiguration, VectorSearchProfile
+    SearchIndex, SimpleField, SearchFieldDataType, SearchableField, SearchField, VectorSearch, HnswAlgorithmConfiguration, VectorSearchProfile,
+    ScalarQuantizationCompression, ScalarQuantizationParameters, HnswParameters, VectorSearchAlgorithmMetric
 )
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from dotenv import load_dotenv
+import numpy as np
 import openai
+import orjson
+import tiktoken
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from openai.types.chat.chat_completion_system_message_param import ChatCompletionSystemMessageParam
 from openai.types.chat.chat_completion_user_message_param import ChatCompletionUserMessageParam
 
@@ -15,27 +27,34 @@ load_dotenv()
 
 # インデックス化（Indexing）
 
-# 1.データのロード
-with open("../data/data_shishin.pdf", "rb") as file:
-    document_bytes = file.read()
-
-
-# 2.Document Intelligence クライアントの作成
+# 1.Document Intelligence クライアントの作成
 client = DocumentAnalysisClient(
     endpoint=os.environ["AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT"],
     credential=AzureKeyCredential(os.environ["AZURE_DOCUMENT_INTELLIGENCE_KEY"])
 )
 
-# 3.データからテキスト抽出
-result = client.begin_analyze_document(model_id=os.environ["AZURE_DOCUMENT_INTELLIGENCE_MODEL"], document=document_bytes).result()
+# 2.データのロードと 3.データからテキスト抽出
+# ファイルを read() せずにファイルオブジェクトのまま渡し、SDK にストリーミング送信させる
+with open("../data/data_shishin.pdf", "rb") as file:
+    poller = client.begin_analyze_document(model_id=os.environ["AZURE_DOCUMENT_INTELLIGENCE_MODEL"], document=file)
+    result = poller.result()
 
 # 4.テキストのチャンク化
 text_chunks = []
+# 512トークン単位での分割（25%のオーバーラップ）
+chunk_size = 512
+overlap_size = int(chunk_size * 0.25)
+
+# OpenAIのトークナイザーを使用
+tokenizer = tiktoken.get_encoding("cl100k_base")
+
 for page in result.pages:
-    page_text = "\n".join([line.content for line in page.lines])
-    # 適当な長さで分割（ここでは300文字ごと）
-    chunk_size = 300
-    chunks = [page_text[i:i+chunk_size] for i in range(0, len(page_text), chunk_size)]
+    page_text = "\n".join(line.content for line in page.lines)
+    # 文字数ではなくトークン数で分割する
+    tokens = tokenizer.encode(page_text)
+    chunks = [
+        tokenizer.decode(tokens[i:i+chunk_size]) for i in range(0, len(tokens), chunk_size - overlap_size)
+    ]
     text_chunks.extend(chunks)
 
 
@@ -51,15 +70,71 @@ azure_openai_client = openai.AzureOpenAI(
     azure_endpoint=azure_endpoint
 )
 
-embedding_results = []
+# トークン数の合計が上限（8192トークン）を超えないようにチャンクをまとめる
+def batched(chunks, max_tokens=7000, max_items=96):
+    batch = []
+    batch_tokens = 0
+    for chunk in chunks:
+        n_tokens = len(tokenizer.encode(chunk))
+        if batch and (batch_tokens + n_tokens > max_tokens or len(batch) >= max_items):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += n_tokens
+    if batch:
+        yield batch
 
-for text in text_chunks:
-    response = azure_openai_client.embeddings.create(
-        model=model,
-        input=[text]  # 1つずつ渡す
-    )
-    embedding_results.append(response.data[0].embedding)
+# レート制限時は Retry-After ヘッダーの秒数だけ待機し、ヘッダーがなければ指数バックオフで待機する
+def wait_retry_after(retry_state):
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        return float(retry_after)
+    return wait_exponential(multiplier=1, max=60)(retry_state)
+
+# レート制限と一時的な障害（タイムアウト・接続エラー・5xx）のみリトライする
+transient_openai_errors = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+# 複数のバッチを同時実行数を制限しながら並列にベクトル化する
+async def embed_all(batches, concurrency=8):
+    async with openai.AsyncAzureOpenAI(
+        api_key=api_key,
+        api_version=api_version,
+        azure_endpoint=azure_endpoint,
+        max_retries=0  # リトライは tenacity で制御する
+    ) as async_client:
+        semaphore = asyncio.Semaphore(concurrency)
 
+        @retry(
+            retry=retry_if_exception_type(transient_openai_errors),
+            wait=wait_retry_after,
+            stop=stop_after_attempt(6),
+            reraise=True
+        )
+        async def _emb(batch):
+            async with semaphore:
+                response = await async_client.embeddings.create(
+                    model=model,
+                    input=batch  # 複数のチャンクをまとめて渡す
+                )
+            # response.data は入力順に対応しているが、念のため index で並べ替える
+            return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+        results = await asyncio.gather(*[_emb(batch) for batch in batches])
+    # gather はタスクの順序で結果を返すため、チャンクの順序が保たれる
+    return [embedding for result in results for embedding in result]
+
+# チャンク本文のハッシュをドキュメント ID とし、前回までにインデックス済みのチャンクはベクトル化をスキップする
+ids = [hashlib.sha1(text.encode()).hexdigest() for text in text_chunks]
+
+# インデックスのベクトル次元数
+embedding_dimensions = 1536
 
 # 6.Azure AI Search Index クライアントの作成
 service_endpoint = os.environ["AZURE_SEARCH_SERVICE_ENDPOINT"]
@@ -74,13 +149,14 @@ search_index_client = SearchIndexClient(
 # 7.インデックスの作成
 
 fields = [
-    SimpleField(name="id", type=SearchFieldDataType.String, key=True),
+    SimpleField(name="id", type=SearchFieldDataType.String, key=True, filterable=True),  # 既存 ID の問い合わせに使う
     SearchableField(name="content", type=SearchFieldDataType.String),
     SearchField(
     name="embedding",
-    type=SearchFieldDataType.Collection(SearchFieldDataType.Single), 
+    # FP16 で保持してインデックスサイズを半分にする
+    type=SearchFieldDataType.Collection(SearchFieldDataType.Half),
     searchable=True,
-    vector_search_dimensions=1536,
+    vector_search_dimensions=embedding_dimensions,
     vector_search_profile_name="hnsw_profile"
 )
 ]
@@ -90,17 +166,69 @@ index = SearchIndex(
     fields=fields,
     vector_search=VectorSearch(
         algorithms=[
-            HnswAlgorithmConfiguration(name="hnsw_algorithm")
+            # 正規化済みのベクトルを格納するため、ノルム計算が不要な内積で比較する
+            HnswAlgorithmConfiguration(
+                name="hnsw_algorithm",
+                parameters=HnswParameters(metric=VectorSearchAlgorithmMetric.DOT_PRODUCT)
+            )
+        ],
+        # スカラー量子化（int8）で HNSW グラフのメモリを削減し、元のベクトルで再スコアリングする
+        compressions=[
+            ScalarQuantizationCompression(
+                compression_name="sq8",
+                rerank_with_original_vectors=True,
+                default_oversampling=10,
+                parameters=ScalarQuantizationParameters(quantized_data_type="int8")
+            )
         ],
         profiles=[
-            VectorSearchProfile(name="hnsw_profile", algorithm_configuration_name="hnsw_algorithm")
+            VectorSearchProfile(name="hnsw_profile", algorithm_configuration_name="hnsw_algorithm", compression_name="sq8")
         ]
     )
 )
 
-search_index_client.create_or_update_index(index)
+# 既存のインデックスの id・embedding フィールドやベクトル検索の設定は create_or_update_index では変更できない
+# （filterable の追加、Single → Half、類似度の指標、圧縮の有無）。定義が異なる場合は削除して作り直す
+def find_field(search_index, name):
+    return next((field for field in search_index.fields if field.name == name), None)
 
-# 8.データのインデックス化
+def vector_profile_settings(search_index, profile_name):
+    vector_search = search_index.vector_search
+    if vector_search is None:
+        return None
+    profile = next((p for p in vector_search.profiles or [] if p.name == profile_name), None)
+    if profile is None:
+        return None
+    algorithm = next((a for a in vector_search.algorithms or [] if a.name == profile.algorithm_configuration_name), None)
+    metric = getattr(getattr(algorithm, "parameters", None), "metric", None)
+    # 取得したインデックスでは列挙型ではなく文字列として返る場合があるため、値の文字列で比較する
+    metric = str(getattr(metric, "value", metric)).lower()
+    return (metric, profile.compression_name)
+
+def is_compatible_index(existing, expected):
+    existing_id, expected_id = find_field(existing, "id"), find_field(expected, "id")
+    existing_embedding, expected_embedding = find_field(existing, "embedding"), find_field(expected, "embedding")
+    if existing_id is None or existing_embedding is None:
+        return False
+    return (
+        existing_id.filterable == expected_id.filterable
+        and existing_embedding.type == expected_embedding.type
+        and existing_embedding.vector_search_dimensions == expected_embedding.vector_search_dimensions
+        and vector_profile_settings(existing, existing_embedding.vector_search_profile_name)
+            == vector_profile_settings(expected, expected_embedding.vector_search_profile_name)
+    )
+
+try:
+    existing_index = search_index_client.get_index(index_name)
+except ResourceNotFoundError:
+    # 初回実行時はインデックスがまだ存在しない
+    existing_index = None
+
+if existing_index is not None and not is_compatible_index(existing_index, index):
+    print(f"Index '{index_name}' has an incompatible schema. Deleting and recreating it.")
+    search_index_client.delete_index(index_name)
+
+search_index_client.create_or_update_index(index)
 
 search_client = SearchClient(
     endpoint=service_endpoint,
@@ -108,9 +236,103 @@ search_client = SearchClient(
     credential=AzureKeyCredential(key)
 )
 
-documents = [
-    {"id": str(i), "content": text_chunks[i], "embedding": list(embedding_results[i])}
-    for i in range(len(text_chunks))
-]
+# インデックスのスキーマが確定してから既存の ID を問い合わせ、未登録のチャンクのみベクトル化する
+def fetch_existing_ids(ids, batch_size=500):
+    existing_ids = set()
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i+batch_size]
+        results = search_client.search(
+            search_text="*",
+            filter=f"search.in(id, '{','.join(batch)}', ',')",
+            select=["id"],
+            top=len(batch)
+        )
+        existing_ids.update(result["id"] for result in results)
+    return existing_ids
+
+existing_ids = fetch_existing_ids(ids)
+
+# 未登録のチャンクのみを対象にする（同一内容のチャンクは 1 つにまとめる）
+new_chunks = {}
+for doc_id, text in zip(ids, text_chunks):
+    if doc_id not in existing_ids:
+        new_chunks.setdefault(doc_id, text)
+new_ids = list(new_chunks.keys())
+new_texts = list(new_chunks.values())
+print(f"{len(existing_ids)} chunks already indexed, embedding {len(new_texts)} new chunks")
+
+embedding_results = asyncio.run(embed_all(list(batched(new_texts))))
+
+# 埋め込みを L2 正規化した float32 の行列にまとめる（正規化済みベクトルでは内積 = コサイン類似度）
+embedding_matrix = np.asarray(embedding_results, dtype=np.float32).reshape(-1, embedding_dimensions)
+embedding_matrix /= np.linalg.norm(embedding_matrix, axis=1, keepdims=True)
+
+# 8.データのインデックス化
+
+# アップロード用のドキュメントは全件をリストに展開せず、ジェネレーターでバッチごとに生成する
+# embedding には正規化済み行列の各行（ビュー）をそのまま使い、リストへの変換は行わない
+def docgen():
+    for doc_id, text, embedding in zip(new_ids, new_texts, embedding_matrix):
+        yield {"id": doc_id, "content": text, "embedding": embedding}
+
+# SDK のクライアントはスレッドセーフが保証されないため、スレッドごとに SearchClient を用意する
+thread_local = threading.local()
+
+def get_thread_search_client():
+    if not hasattr(thread_local, "search_client"):
+        thread_local.search_client = SearchClient(
+            endpoint=service_endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(key)
+        )
+    return thread_local.search_client
+
+# SDK 標準の json ではなく orjson でシリアライズしたペイロードを REST API に直接送信する
+# send_request はクライアントのパイプラインを通るため、認証や Retry-After に従ったリトライはそのまま適用される
+search_api_version = os.environ.get("AZURE_SEARCH_API_VERSION", "2024-07-01")
+
+def upload_batch(docs):
+    body = orjson.dumps(
+        {"value": [{"@search.action": "upload", **doc} for doc in docs]},
+        option=orjson.OPT_SERIALIZE_NUMPY  # NumPy 配列をそのまま JSON 配列として書き出す
+    )
+    request = HttpRequest(
+        "POST",
+        f"{service_endpoint}/indexes/{index_name}/docs/index",
+        params={"api-version": search_api_version},
+        headers={"Content-Type": "application/json"},
+        content=body
+    )
+    response = get_thread_search_client().send_request(request)
+    response.raise_for_status()
+    failed_keys = [r["key"] for r in response.json()["value"] if not r["status"]]
+    if failed_keys:
+        print(f"Failed to upload {len(failed_keys)} documents: {failed_keys[:5]}")
+    return response
+
+# 1000件ずつに分割
+def split_batches(items, batch_size=1000):
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+# 分割したバッチを並列にアップロード
+# executor.map は入力を先にすべて読み込むため、実行中のバッチ数を制限しながら投入する
+max_workers = 8
+with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    in_flight = set()
+    for batch in split_batches(docgen()):
+        if len(in_flight) >= max_workers:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        in_flight.add(executor.submit(upload_batch, batch))
+    for future in as_completed(in_flight):
+        future.result()
 
-search_client.upload_documents(documents)
\ No newline at end of file
+# 今回のチャンクに含まれないドキュメント（内容が変わったチャンクや、連番 ID で登録された旧形式のドキュメント）を削除する
+current_ids = set(ids)
+stale_ids = [result["id"] for result in search_client.search(search_text="*", select=["id"]) if result["id"] not in current_ids]
+for batch in split_batches(stale_ids):
+    search_client.delete_documents(documents=[{"id": doc_id} for doc_id in batch])
+print(f"Deleted {len(stale_ids)} stale documents")
@@ -1,25 +1,43 @@
+import functools
+import hashlib
+import shelve
+import numpy as np
+
 # 情報検索（Retrieval）
 
 # 1. クエリのベクトル化
 
+# 同じクエリを再度ベクトル化しないよう、結果をメモリ（LRU）とディスク（shelve）にキャッシュする
+@functools.lru_cache(maxsize=4096)
+def embed_query(text):
+    # モデル名とクエリのハッシュをキーにして、キャッシュのキー長を一定に保つ
+    cache_key = f"{model}:{hashlib.sha1(text.encode()).hexdigest()}"
+    with shelve.open("./emb_cache") as cache:
+        if cache_key not in cache:
+            cache[cache_key] = azure_openai_client.embeddings.create(
+                model=model,
+                input=[text]
+            ).data[0].embedding
+        return tuple(cache[cache_key])
+
 query_text = "オープンデータとは"
-query_embedding = azure_openai_client.embeddings.create(
-    model=model,
-    input=[query_text]
-).data[0].embedding
+
+# インデックス側と同様にクエリベクトルも L2 正規化する（内積 = コサイン類似度）
+query_vector = np.asarray(embed_query(query_text), dtype=np.float32)
+query_embedding = (query_vector / np.linalg.norm(query_vector)).tolist()
 
 # 2. クエリの実行
 
 vector_query = {
     "vector": query_embedding,
-    "k": 5,
+    "k": 3,  # 取得件数（top）と揃える
     "fields": "embedding",
     "kind": "vector",
     "profile": "hnsw_profile"
 }
 
 search_results = search_client.search(
-    search_text="",
+    search_text=None,  # 空文字列ではなく None にしてテキスト検索を行わない
     vector_queries=[vector_query],
     select=["id", "content"],
     top=3
@@ -41,13 +41,64 @@ azure_openai_client = openai.AzureOpenAI(
     azure_endpoint=azure_endpoint
 )
 
-# 3. LLMへのリクエスト
-response = azure_openai_client.chat.completions.create(
-    model=model,
-    messages=[system_prompt, user_prompt],
-    temperature=0.0
+# 3. セマンティックキャッシュの確認
+# 過去の質問とその回答をベクトルとともに別インデックスに保存し、類似した質問には LLM を呼ばずに回答する
+cache_index_name = "semantic_cache"
+search_index_client.create_or_update_index(
+    SearchIndex(
+        name=cache_index_name,
+        fields=[
+            SimpleField(name="id", type=SearchFieldDataType.String, key=True),
+            SimpleField(name="query", type=SearchFieldDataType.String),
+            SimpleField(name="response", type=SearchFieldDataType.String),
+            SearchField(
+                name="query_embedding",
+                type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+                searchable=True,
+                vector_search_dimensions=1536,
+                vector_search_profile_name="cache_profile"
+            )
+        ],
+        vector_search=VectorSearch(
+            algorithms=[HnswAlgorithmConfiguration(name="cache_hnsw_algorithm")],
+            profiles=[VectorSearchProfile(name="cache_profile", algorithm_configuration_name="cache_hnsw_algorithm")]
+        )
+    )
+)
+
+cache_search_client = SearchClient(
+    endpoint=service_endpoint,
+    index_name=cache_index_name,
+    credential=AzureKeyCredential(key)
 )
 
-# 4. 回答
-response_text = response.choices[0].message.content
+# コサイン類似度のスコアは 1 / (1 + (1 - cos)) で返るため、0.95 は cos ≒ 0.947 に相当する
+cache_threshold = 0.95
+cache_hits = list(cache_search_client.search(
+    search_text=None,
+    vector_queries=[{"vector": query_embedding, "k": 1, "fields": "query_embedding", "kind": "vector"}],
+    select=["response"],
+    top=1
+))
+
+# 4. LLMへのリクエスト（キャッシュにヒットした場合は省略）
+if cache_hits and cache_hits[0]["@search.score"] >= cache_threshold:
+    response_text = cache_hits[0]["response"]
+else:
+    response = azure_openai_client.chat.completions.create(
+        model=model,
+        messages=[system_prompt, user_prompt],
+        temperature=0.0
+    )
+    response_text = response.choices[0].message.content
+
+    # 質問と回答をキャッシュに保存
+    cache_search_client.upload_documents([{
+        "id": hashlib.sha1(query_text.encode()).hexdigest(),
+        "query": query_text,
+        "response": response_text,
+        "query_embedding": query_embedding
+    }])
+
+# 5. 回答
 print(response_text)
\ No newline at end of file
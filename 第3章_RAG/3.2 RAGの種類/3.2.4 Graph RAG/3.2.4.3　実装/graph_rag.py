@@ -1,50 +1,119 @@
 import asyncio
 from collections import Counter
 from datetime import datetime, timezone
-import json
-import math
+from itertools import chain
+import functools
+import hashlib
+import logging
+import logging.handlers
 import os
-import textwrap
+import queue
 import uuid
+import httpx
 import openai
+import orjson
 import pandas as pd
 import pyarrow as pa
-from typing import List, Dict, Optional, Tuple, cast
-from dataclasses import dataclass, asdict
+from typing import List, Dict, Optional, Tuple, Union, cast
+from dataclasses import dataclass, asdict, is_dataclass
+from pydantic import BaseModel
 import pyarrow.parquet as pq
 import networkx as nx
 from graspologic.partition import hierarchical_leiden
 import numpy as np
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from azure.core.exceptions import ResourceNotFoundError
+from azure.search.documents import SearchClient, SearchIndexingBufferedSender
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
     SearchIndex, SearchField, SearchFieldDataType,
     SimpleField, SearchableField,
-    VectorSearch, VectorSearchProfile, HnswAlgorithmConfiguration
+    VectorSearch, VectorSearchProfile, HnswAlgorithmConfiguration,
+    ScalarQuantizationCompression, ScalarQuantizationParameters
 )
 
 
 import tiktoken
 
+# ==== ログの設定 ====
+# 並行タスクから print すると標準出力のロックを奪い合うため、ログはキューに積み、
+# 出力は QueueListener の別スレッドにまとめて任せる
+log_queue = queue.Queue(-1)
+logger = logging.getLogger("rag")
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+
 # ==== Azure OpenAI クライアントの設定 ====
 api_key = os.getenv("AZURE_OPENAI_API_KEY")
 api_version = os.getenv("AZURE_OPENAI_API_VERSION")
 azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
 chat_model = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
 
+# 多数の LLM / 埋め込み呼び出しを並列に行うため、HTTP/2 で接続を多重化し、接続プールをチャットと埋め込みで共有する
+# （HTTP/2 の利用には h2 パッケージが必要: pip install "httpx[http2]"）
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+    timeout=60.0,
+)
+
 async_openai_client = openai.AsyncAzureOpenAI(
     api_key=api_key,
     api_version=api_version,
     azure_endpoint=azure_endpoint,
+    http_client=http_client,
+    max_retries=0  # リトライは tenacity で制御する
+)
+
+# レート制限時は Retry-After ヘッダーの秒数だけ待機し、ヘッダーがなければ指数バックオフで待機する
+def wait_retry_after(retry_state):
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        return float(retry_after)
+    return wait_exponential(multiplier=1, max=60)(retry_state)
+
+# チャット呼び出し全体で同時実行数を制限する（各処理の並列数の合計がレート制限を超えないようにする）
+chat_semaphore = asyncio.Semaphore(16)
+
+# レート制限と一時的な障害（タイムアウト・接続エラー・5xx）のみリトライする
+transient_openai_errors = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
 )
 
+chat_retry = retry(
+    retry=retry_if_exception_type(transient_openai_errors),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+
+@chat_retry
+async def create_chat_completion(**kwargs):
+    async with chat_semaphore:
+        return await async_openai_client.chat.completions.create(**kwargs)
+
+# 構造化出力（response_format に Pydantic モデルを指定）を使い、解析済みのオブジェクトを受け取る
+@chat_retry
+async def parse_chat_completion(**kwargs):
+    async with chat_semaphore:
+        return await async_openai_client.beta.chat.completions.parse(**kwargs)
+
 api_key = os.getenv("AZURE_SEARCH_API_KEY")
 endpoint = os.getenv("AZURE_SEARCH_SERVICE_ENDPOINT")
 async_embedding_client = openai.AsyncAzureOpenAI(
     api_key=os.getenv("AZURE_OPENAI_EMBEDDING_API_KEY"),
     api_version=os.getenv("AZURE_OPENAI_EMBEDDING_API_VERSION"),
-    azure_endpoint=os.getenv("AZURE_OPENAI_EMBEDDING_ENDPOINT")
+    azure_endpoint=os.getenv("AZURE_OPENAI_EMBEDDING_ENDPOINT"),
+    http_client=http_client,
+    max_retries=0  # リトライは tenacity で制御する
 )
 embedding_model = os.getenv("AZURE_OPENAI_EMBEDDING_MODEL_DEPLOYMENT_NAME")
 
@@ -160,7 +229,7 @@ class TextUnit:
     covariate_ids: Optional[Dict[str, List[str]]] = None
     n_tokens: Optional[int] = None
     attributes: Optional[Dict[str, str]] = None
-    embedding: Optional[List[float]] = None
+    embedding: Optional[np.ndarray] = None  # float32 の 1 次元配列
 
 @dataclass
 class Entity:
@@ -168,8 +237,8 @@ class Entity:
     title: str
     type: Optional[str] = None
     description: Optional[str] = None
-    description_embedding: Optional[List[float]] = None
-    name_embedding: Optional[List[float]] = None
+    description_embedding: Optional[np.ndarray] = None
+    name_embedding: Optional[np.ndarray] = None
     community_ids: Optional[List[str]] = None
     text_unit_ids: Optional[List[str]] = None
     rank: Optional[int] = None
@@ -181,7 +250,7 @@ class Relationship:
     source: str
     target: str
     description: Optional[str] = None
-    description_embedding: Optional[List[float]] = None
+    description_embedding: Optional[np.ndarray] = None
     text_unit_ids: Optional[List[str]] = None
     rank: Optional[int] = None
     weight: float = 1.0
@@ -218,39 +287,61 @@ class CommunityReport:
     summary: str
     full_content: str
     rank: float = 1.0
-    full_content_embedding: Optional[List[float]] = None
+    full_content_embedding: Optional[np.ndarray] = None
     attributes: Optional[Dict[str, str]] = None
     size: Optional[int] = None
     period: Optional[str] = None
 
 # --- 2. Dataclass を Pandas DataFrame に変換する関数 ---
 
+# 埋め込みベクトルを保持する列
+EMBEDDING_COLUMNS = ("embedding", "description_embedding", "name_embedding", "full_content_embedding")
+
 def dataclass_to_dataframe(objects: List) -> pd.DataFrame:
-    return pd.DataFrame([asdict(obj) for obj in objects])
+    df = pd.DataFrame([asdict(obj) for obj in objects])
+    # 埋め込みベクトルは 1 つの連続した float32 の 2 次元配列にまとめ、各行はその行ビューを参照させる
+    for col in EMBEDDING_COLUMNS:
+        if col in df.columns and len(df) > 0 and df[col].notna().all():
+            matrix = np.vstack(df[col].to_list()).astype(np.float32, copy=False)
+            df[col] = pd.Series(list(matrix), index=df.index, dtype=object)
+    return df
+
+def dataclass_to_table(objects: List, schema: Optional[pa.Schema] = None) -> pa.Table:
+    # asdict による再帰的なコピーと Pandas を経由せず、dataclass から直接 Arrow Table を作成する
+    # ネストした dataclass を持つフィールドのみ asdict で辞書に変換する
+    rows = [
+        {key: asdict(value) if is_dataclass(value) else value for key, value in vars(obj).items()}
+        for obj in objects
+    ]
+    return pa.Table.from_pylist(rows, schema=schema)
 
-def append_to_parquet(df: pd.DataFrame, file_path: str):
+def append_to_parquet(data: Union[pd.DataFrame, pa.Table], dir_path: str):
+    # 既存ファイルを読み直して書き換えるのではなく、ディレクトリ配下に新しいパートファイルとして追記する
+    # 読み込み時は pd.read_parquet(dir_path) がディレクトリ内の全ファイルをまとめて読み込む
+    # 後続の処理がこのファイルを読み込むため、書き込みに失敗した場合はエラーを送出する
     try:
-        table = pa.Table.from_pandas(df)
-        if os.path.exists(file_path):
-            existing_table = pq.read_table(file_path)
-            combined_table = pa.concat_tables([existing_table, table])
-            pq.write_table(combined_table, file_path)
-        else:
-            pq.write_table(table, file_path)
-        print(f"Data successfully appended to {file_path}")
+        table = data if isinstance(data, pa.Table) else pa.Table.from_pandas(data, preserve_index=False)
+        if os.path.isfile(dir_path):
+            # 以前の実行で単一ファイルとして書き出されたデータは、ディレクトリ内の最初のパートファイルとして移行する
+            legacy_path = f"{dir_path}.legacy-{uuid.uuid4()}"
+            os.replace(dir_path, legacy_path)
+            os.makedirs(dir_path)
+            os.replace(legacy_path, os.path.join(dir_path, "part-legacy.parquet"))
+            logger.info(f"Migrated existing file {dir_path} into a part file")
+        os.makedirs(dir_path, exist_ok=True)
+        pq.write_table(table, os.path.join(dir_path, f"part-{uuid.uuid4()}.parquet"))
+        logger.info(f"Data successfully appended to {dir_path}")
     except Exception as e:
-        print(f"Error appending data to {file_path}: {e}")
+        logger.error(f"Error appending data to {dir_path}: {e}")
+        raise
 
 # --- 3. エンコーディング関数 ---
 
-def get_encoding_fn(encoding_name: str):
-    """Get the encoding model."""
-    enc = tiktoken.get_encoding(encoding_name)
-    
-    def encode(text: str) -> list[int]:
-        return enc.encode(text if isinstance(text, str) else str(text))
-    
-    return encode
+@functools.lru_cache(maxsize=4)
+def get_encoding(encoding_name: str) -> tiktoken.Encoding:
+    """Get the encoding model once per process."""
+    # チャンクをまとめてトークナイズできるよう、encode のクロージャではなく Encoding オブジェクトを返す
+    return tiktoken.get_encoding(encoding_name)
 
 
 # ドキュメントの作成
@@ -540,29 +631,32 @@ TBSホールディングス
     return dataclass_to_dataframe(documents)
 
 
-async def create_text_chunks_async(row: pd.Series, chunk_size: int, id_prefix: str, chunk_start_id: int, encode) -> list[TextUnit]:
+async def create_text_chunks_async(row: pd.Series, chunk_size: int, id_prefix: str, chunk_start_id: int, encoding: tiktoken.Encoding) -> list[TextUnit]:
     """ 1つのドキュメントを非同期でチャンク化し、リストとして返す。 """
     doc_id = row["id"]
-    text_chunks = await asyncio.to_thread(textwrap.wrap, row["text"], width=chunk_size)
+    # 空白で区切られない日本語では textwrap は実質 1 文字ずつの走査になるため、固定長のスライスで分割する
+    text = row["text"]
+    text_chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
     
-    chunked_data = []
-    for i, chunk in enumerate(text_chunks):
-        token_count = await asyncio.to_thread(encode, chunk)
-        chunked_data.append(TextUnit(
+    # チャンクごとに encode を呼ぶのではなく、encode_batch で 1 回にまとめて並列にトークナイズする
+    token_lists = await asyncio.to_thread(encoding.encode_batch, text_chunks, num_threads=os.cpu_count() or 1)
+    
+    return [
+        TextUnit(
             id=f"{id_prefix}_{chunk_start_id + i}",
             document_id=doc_id,
             text=chunk,
-            n_tokens=len(token_count)
-        ))
-    
-    return chunked_data
+            n_tokens=len(tokens)
+        )
+        for i, (chunk, tokens) in enumerate(zip(text_chunks, token_lists))
+    ]
 
 
 async def create_text_units(documents: pd.DataFrame, chunk_size: int = 100, id_prefix: str = "chunk", encoding_name: str = "o200k_base") -> pd.DataFrame:
     """ 分割されたテキストチャンクを含むデータフレームを非同期で作成する。 """
-    encode = get_encoding_fn(encoding_name)
+    encoding = get_encoding(encoding_name)
     tasks = [
-        create_text_chunks_async(row, chunk_size, id_prefix, idx * 1000, encode)
+        create_text_chunks_async(row, chunk_size, id_prefix, idx * 1000, encoding)
         for idx, row in documents.iterrows()
     ]
     results = await asyncio.gather(*tasks)
@@ -572,109 +666,257 @@ async def create_text_units(documents: pd.DataFrame, chunk_size: int = 100, id_p
 
 async def create_final_documents_async(documents: pd.DataFrame, text_units: pd.DataFrame) -> pd.DataFrame:
     """All the steps to transform final documents asynchronously."""
-    exploded = await asyncio.to_thread(lambda: (
-        text_units.explode("document_id")
-        .loc[:, ["id", "document_id", "text"]]
-        .rename(columns={
+
+    def transform() -> pd.DataFrame:
+        # TextUnit の document_id はスカラー値のため explode は不要
+        chunks = text_units[["id", "document_id", "text"]].rename(columns={
             "document_id": "chunk_doc_id",
             "id": "chunk_id",
             "text": "chunk_text",
         })
-    ))
-    joined = await asyncio.to_thread(lambda: exploded.merge(
-        documents,
-        left_on="chunk_doc_id",
-        right_on="id",
-        how="inner",
-        copy=False,
-    ))
-    docs_with_text_units = await asyncio.to_thread(lambda: joined.groupby("id", sort=False).agg(
-        text_unit_ids=("chunk_id", list)
-    ))
-    rejoined = await asyncio.to_thread(lambda: docs_with_text_units.merge(
-        documents,
-        on="id",
-        how="right",
-        copy=False,
-    ).reset_index(drop=True))
+        joined = chunks.merge(
+            documents,
+            left_on="chunk_doc_id",
+            right_on="id",
+            how="inner",
+            sort=False,
+        )
+        docs_with_text_units = (
+            joined.groupby("id", sort=False)
+            .agg({"chunk_id": list})
+            .rename(columns={"chunk_id": "text_unit_ids"})
+        )
+        return docs_with_text_units.merge(
+            documents,
+            on="id",
+            how="right",
+            sort=False,
+        ).reset_index(drop=True)
+
+    # 一連の pandas の処理は 1 回のスレッド切り替えでまとめて実行する
+    rejoined = await asyncio.to_thread(transform)
     rejoined["id"] = rejoined["id"].astype(str)
     rejoined["human_readable_id"] = rejoined.index + 1
     return rejoined
 
-async def extract_entities(text: str) -> Tuple[List[Entity], List[Relationship]]:
-    prompt = f"""
-    以下のテキストからエンティティとリレーションシップを抽出してください。
-    
-    テキスト: {text}
+def batch_uuids(n: int) -> List[str]:
+    # os.urandom を 1 回だけ呼び出して n 個分の乱数を取得し、16 バイトずつ UUID (version 4) にする
+    buf = os.urandom(16 * n)
+    return [str(uuid.UUID(bytes=buf[i * 16:(i + 1) * 16], version=4)) for i in range(n)]
+
+# 指示と出力形式は全呼び出しで共通の system メッセージにまとめ、テキストだけを user メッセージで渡す
+# （先頭部分がバイト列として同一になるため、プロンプトキャッシュが効きやすくなる）
+ENTITY_EXTRACTION_PROMPT = """You are an AI assistant.
+
+    ユーザーから与えられたテキストからエンティティとリレーションシップを抽出してください。
     
     出力は以下のJSON形式で返してください：
-    {{
+    {
       "entities": [
-        {{"title": "エンティティ名", "type": "エンティティタイプ", "description": "エンティティの詳細説明", }}
+        {"title": "エンティティ名", "type": "エンティティタイプ", "description": "エンティティの詳細説明", }
       ],
       "relationships": [
-        {{"source": "ソースエンティティ", "target": "ターゲットエンティティ", "description": "ソースエンティティとタターゲットエンティティの関係の説明", }}
+        {"source": "ソースエンティティ", "target": "ターゲットエンティティ", "description": "ソースエンティティとタターゲットエンティティの関係の説明", }
       ]
-    }}
+    }
     """
 
+async def extract_entities(text: str) -> Tuple[List[Entity], List[Relationship]]:
     try:
-        response = await async_openai_client.chat.completions.create(
+        response = await create_chat_completion(
             model=chat_model,
             messages=[
-                {"role": "system", "content": "You are an AI assistant."},
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": ENTITY_EXTRACTION_PROMPT},
+                {"role": "user", "content": f"テキスト: {text}"}
             ],
             response_format={"type": "json_object"},
             temperature=0.2,
         )
         
         response_content = response.choices[0].message.content.strip()
-        parsed_data = json.loads(response_content)
+        parsed_data = orjson.loads(response_content)
+
+        parsed_entities = parsed_data.get("entities", [])
+        parsed_relationships = parsed_data.get("relationships", [])
+        # エンティティとリレーションシップの ID をまとめて生成
+        ids = batch_uuids(len(parsed_entities) + len(parsed_relationships))
 
         # エンティティを作成（idを自動生成）
         entities = [
-            Entity(id=str(uuid.uuid4()), **entity)  # IDをUUIDで自動生成
-            for entity in parsed_data.get("entities", [])
+            Entity(id=entity_id, **entity)  # IDをUUIDで自動生成
+            for entity_id, entity in zip(ids, parsed_entities)
         ]
 
         # リレーションシップも同様に処理
         relationships = [
-            Relationship(id=str(uuid.uuid4()), **relationship)  # IDをUUIDで自動生成
-            for relationship in parsed_data.get("relationships", [])
+            Relationship(id=relationship_id, **relationship)  # IDをUUIDで自動生成
+            for relationship_id, relationship in zip(ids[len(parsed_entities):], parsed_relationships)
         ]
 
         return entities, relationships   
     except Exception as e:
-        print(f"Error extracting entities: {e}")
+        logger.error(f"Error extracting entities: {e}")
         raise
 
-async def extract_graph(text_units: pd.DataFrame, text_column: str = "text"):
+# ParquetWriter で追記するため、entities / relationships のスキーマを固定する
+entity_schema = pa.schema([
+    ("id", pa.string()),
+    ("title", pa.string()),
+    ("type", pa.string()),
+    ("description", pa.string()),
+    ("description_embedding", pa.list_(pa.float32())),
+    ("name_embedding", pa.list_(pa.float32())),
+    ("community_ids", pa.list_(pa.string())),
+    ("text_unit_ids", pa.list_(pa.string())),
+    ("rank", pa.int64()),
+    ("attributes", pa.map_(pa.string(), pa.string())),
+])
+
+relationship_schema = pa.schema([
+    ("id", pa.string()),
+    ("source", pa.string()),
+    ("target", pa.string()),
+    ("description", pa.string()),
+    ("description_embedding", pa.list_(pa.float32())),
+    ("text_unit_ids", pa.list_(pa.string())),
+    ("rank", pa.int64()),
+    ("weight", pa.float64()),
+    ("attributes", pa.map_(pa.string(), pa.string())),
+])
+
+def simhash(text: str, n: int = 3) -> int:
+    """文字 n-gram から 64 ビットの SimHash を計算する。"""
+    # 日本語は空白で区切られないため、単語ではなく文字 n-gram を特徴量にする
+    grams = [text[i:i + n] for i in range(max(len(text) - n + 1, 1))]
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest(), "big") for g in grams],
+        dtype=np.uint64,
+    )
+    # 各ビットについて 1 の n-gram が過半数ならそのビットを立てる
+    bits = (hashes[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    ones = bits.sum(axis=0)
+    return sum(1 << int(i) for i in np.flatnonzero(ones * 2 > len(grams)))
+
+def group_near_duplicates(ids: List[str], texts: List[str], max_distance: int = 3) -> Dict[str, List[str]]:
+    """SimHash のハミング距離が max_distance 以内のチャンクをまとめ、{代表チャンクのID: [重複チャンクのID]} を返す。"""
+    # SimHash を max_distance + 1 個のブロックに分けると、距離が max_distance 以内なら少なくとも 1 つのブロックが一致する
+    # ブロックの値をキーにしたバケットから候補だけを取り出して距離を確認する
+    num_bands = max_distance + 1
+    band_bits = 64 // num_bands
+    band_mask = (1 << band_bits) - 1
+    buckets: Dict[Tuple[int, int], List[Tuple[str, int]]] = {}
+    groups: Dict[str, List[str]] = {}
+    for text_unit_id, text in zip(ids, texts):
+        value = simhash(text)
+        bands = [(b, (value >> (b * band_bits)) & band_mask) for b in range(num_bands)]
+        representative = next(
+            (
+                rep_id
+                for band in bands
+                for rep_id, rep_value in buckets.get(band, [])
+                if bin(value ^ rep_value).count("1") <= max_distance
+            ),
+            None,
+        )
+        if representative is not None:
+            groups[representative].append(text_unit_id)
+            continue
+        groups[text_unit_id] = []
+        for band in bands:
+            buckets.setdefault(band, []).append((text_unit_id, value))
+    return groups
+
+async def extract_graph(text_units: pd.DataFrame, text_column: str = "text", concurrency: int = 16, flush_size: int = 500, dedup_distance: Optional[int] = 3):
+    # ほぼ重複したチャンクは代表のチャンクだけを LLM に渡し、抽出結果を重複チャンクとも共有する
+    # （dedup_distance に None を指定すると重複除去を行わない）
+    if dedup_distance is None:
+        duplicates = {text_unit_id: [] for text_unit_id in text_units["id"]}
+    else:
+        duplicates = group_near_duplicates(text_units["id"].tolist(), text_units[text_column].tolist(), dedup_distance)
+        skipped = len(text_units) - len(duplicates)
+        # 実際にスキップした場合のみ警告する
+        if skipped:
+            logger.warning(f"Skipping {skipped} near-duplicate text units")
+        else:
+            logger.info("No near-duplicate text units found")
+    representatives = text_units[text_units["id"].isin(duplicates.keys())]
+
+    # LLM 呼び出しは行ごとに独立しているため、同時実行数をセマフォで制限しつつ並列に実行する
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def extract_row(row: pd.Series):
+        text_unit_ids = [row["id"], *duplicates[row["id"]]]
+        async with semaphore:
+            try:
+                return text_unit_ids, await extract_entities(row[text_column])
+            except Exception as e:
+                # 1 行の失敗（不正な応答など）で全体を止めず、その行は抽出結果なしとして続行する
+                logger.error(f"Skipping text unit {row['id']}: {e}")
+                return text_unit_ids, ([], [])
+
+    # 抽出結果はメモリ上にためておき、flush_size 件ごとにまとめて書き出す
+    entity_buffer: List[Entity] = []
+    relationship_buffer: List[Relationship] = []
+
+    # ライターは最初に 1 度だけ開き、バッチごとに行グループとして追記する（既存ファイルの読み直しは不要）
+    entity_writer = pq.ParquetWriter("entities.parquet", entity_schema, compression="snappy")
+    relationship_writer = pq.ParquetWriter("relationships.parquet", relationship_schema, compression="snappy")
+
+    def flush():
+        if entity_buffer:
+            entity_writer.write_table(dataclass_to_table(entity_buffer, schema=entity_schema))
+            entity_buffer.clear()
+        if relationship_buffer:
+            relationship_writer.write_table(dataclass_to_table(relationship_buffer, schema=relationship_schema))
+            relationship_buffer.clear()
+
+    tasks = [asyncio.create_task(extract_row(row)) for _, row in representatives.iterrows()]
     try:
-        # １行ずつ逐次処理
-        for _, row in text_units.iterrows():
-            text = row[text_column]
-            entities, relationships = await extract_entities(text)
+        # 完了した順に結果を受け取る
+        for future in asyncio.as_completed(tasks):
+            text_unit_ids, (entities, relationships) = await future
 
-            # １行毎に複数のentitiesが取得できる為、関係性を表現するためにIDを付与
+            # １行毎に複数のentitiesが取得できる為、関係性を表現するためにIDを付与（重複チャンクのIDも含める）
             for entity in entities:
-                print(entity)
-                entity.__dict__["text_unit_ids"] = [row["id"]]
-                entity_df = pd.DataFrame([entity.__dict__])
-                append_to_parquet(entity_df, "entities.parquet")
-            # １行毎に複数のrelationshipsが取得できる為、関係性を表現するためにIDを付与
+                logger.info("%s", entity)
+                entity.text_unit_ids = text_unit_ids
+            entity_buffer.extend(entities)
+            # １行毎に複数のrelationshipsが取得できる為、関係性を表現するためにIDを付与（重複チャンクのIDも含める）
             for relationship in relationships:
-                print(relationship)
-                relationship.__dict__["text_unit_ids"] = [row["id"]]
-                relationship_df = pd.DataFrame([relationship.__dict__])
-                append_to_parquet(relationship_df, "relationships.parquet")
+                logger.info("%s", relationship)
+                relationship.text_unit_ids = text_unit_ids
+            relationship_buffer.extend(relationships)
+
+            if len(entity_buffer) + len(relationship_buffer) >= flush_size:
+                flush()
 
     except Exception as e:
-        print(f"Error extracting graph: {e}")
+        logger.error(f"Error extracting graph: {e}")
+        raise
+    finally:
+        # 中断した場合は、実行中の LLM 呼び出しを取り消してから終了する
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # エラーで中断した場合も、それまでに抽出できた分は書き出してからライターを閉じる
+        try:
+            flush()
+        finally:
+            entity_writer.close()
+            relationship_writer.close()
 
 # Pandas DataFrame形式のrelationshipからnetworkxのグラフを作成
 async def create_graph_from_pandas_relationship(relationships_df: pd.DataFrame) -> nx.Graph:
-    return await asyncio.to_thread(nx.from_pandas_edgelist, relationships_df, "source", "target")
+    def build_weighted_graph() -> nx.Graph:
+        # 無向グラフのため (source, target) の向きをそろえ、同じノード間のリレーションの件数を辺の重みにまとめる
+        pairs = pd.DataFrame(
+            np.sort(relationships_df[["source", "target"]].to_numpy(dtype=str), axis=1),
+            columns=["source", "target"],
+        )
+        weights = pairs.groupby(["source", "target"], sort=False).size().reset_index(name="weight")
+        return nx.from_pandas_edgelist(weights, "source", "target", edge_attr="weight")
+
+    return await asyncio.to_thread(build_weighted_graph)
 
 # ノードの次数を計算
 async def compute_node_degrees_from_graph(graph: nx.Graph) -> pd.DataFrame:
@@ -684,26 +926,37 @@ async def compute_node_degrees_from_graph(graph: nx.Graph) -> pd.DataFrame:
         ]
     ))
 
-async def layout_graph(graph: nx.Graph) -> pd.DataFrame:
+async def layout_graph(graph: nx.Graph, max_nodes: int = 5000) -> pd.DataFrame:
+    # レイアウトは可視化にしか使わないため、計算コストが大きくなる大規模なグラフでは省略する
+    # （x, y は finalize_entities で 0 として補完される）
+    if graph.number_of_nodes() > max_nodes:
+        logger.warning(f"Skipping layout for a graph with {graph.number_of_nodes()} nodes (max_nodes={max_nodes})")
+        return pd.DataFrame(columns=["title", "x", "y"])
     position = await asyncio.to_thread(nx.spring_layout, graph)
     layout_data = [{"title": node, "x": position[node][0], "y": position[node][1]} for node in graph.nodes]
     return pd.DataFrame(layout_data)
 
 def compute_node_frequency_from_pandas_relations(relationships_df: pd.DataFrame) -> pd.DataFrame:
-    frequency_df = (relationships_df["source"].value_counts() + relationships_df["target"].value_counts()).reset_index()
-    frequency_df.columns = ["title", "frequency"]
-    return frequency_df.fillna(0).astype({"frequency": int})
+    # source と target を 1 本の列にまとめて 1 回で数えることで、Series 同士の加算で生じる NaN の補完や型変換を不要にする
+    frequency = pd.concat([relationships_df["source"], relationships_df["target"]], ignore_index=True).value_counts()
+    return frequency.rename_axis("title").reset_index(name="frequency")
 
-async def finalize_entities():
-    entities_df = pd.read_parquet("entities.parquet")
-    relationships_df = pd.read_parquet("relationships.parquet")
+async def finalize_entities(graph: Optional[nx.Graph] = None, node_degree_df: Optional[pd.DataFrame] = None):
+    # 必要な列だけを読み込む（埋め込みなどの未使用の列はデシリアライズしない）
+    entities_df = pd.read_parquet("entities.parquet", columns=["id", "title", "type", "description", "text_unit_ids"])
+    relationships_df = pd.read_parquet("relationships.parquet", columns=["source", "target"])
 
-    graph = await create_graph_from_pandas_relationship(relationships_df)
+    # グラフと次数が渡されていない場合のみ作成する
+    if graph is None:
+        graph = await create_graph_from_pandas_relationship(relationships_df)
 
-    layout_df, node_degree_df = await asyncio.gather(
-        layout_graph(graph),
-        compute_node_degrees_from_graph(graph)
-    )
+    if node_degree_df is None:
+        layout_df, node_degree_df = await asyncio.gather(
+            layout_graph(graph),
+            compute_node_degrees_from_graph(graph)
+        )
+    else:
+        layout_df = await layout_graph(graph)
 
     node_frequency_df = compute_node_frequency_from_pandas_relations(relationships_df)
 
@@ -711,7 +964,7 @@ async def finalize_entities():
         return entities_df.merge(
             node_degree_df, on="title").merge(
                 node_frequency_df, on="title").merge(
-                    layout_df, on="title").reset_index(drop=True)
+                    layout_df, on="title", how="left").reset_index(drop=True)
     
     def process_missing_value(df: pd.DataFrame) -> pd.DataFrame:
         return df.fillna(0).astype({"degree": int, "frequency": int})
@@ -719,7 +972,7 @@ async def finalize_entities():
     final_entities_df = merge_dataframes(entities_df, node_degree_df, node_frequency_df, layout_df)
     final_entities_df = process_missing_value(final_entities_df)
     append_to_parquet(final_entities_df, "final_entities.parquet")
-    print("Finalized entities complete.")
+    logger.info("Finalized entities complete.")
 
 def compute_edge_combined_degree(
     edge_df: pd.DataFrame,
@@ -731,41 +984,27 @@ def compute_edge_combined_degree(
 ) -> pd.Series:
     """Compute the combined degree for each edge in a graph."""
 
-    def degree_colname(column: str) -> str:
-        return f"{column}_degree"
-    
-    def join_to_degree(df: pd.DataFrame, column: str) -> pd.DataFrame:
-        degree_column = degree_colname(column)
-        result = df.merge(
-            node_degree_df.rename(
-                columns={node_name_column: column, node_degree_column: degree_column}
-            ),
-            on=column,
-            how="left",
-        )
-        result[degree_column] = result[degree_column].fillna(0)
-        return result
-
-
-    output_df = join_to_degree(edge_df, edge_source_column)
-    output_df = join_to_degree(output_df, edge_target_column)
-    output_df["combined_degree"] = (
-        output_df[degree_colname(edge_source_column)]
-        + output_df[degree_colname(edge_target_column)]
-    )
-    return cast("pd.Series", output_df["combined_degree"])
+    # ノード名 → 次数 の辞書を作り、merge ではなく map で source / target の次数を引く
+    degree = dict(zip(node_degree_df[node_name_column], node_degree_df[node_degree_column]))
+    source_degree = edge_df[edge_source_column].map(degree).fillna(0).astype(int)
+    target_degree = edge_df[edge_target_column].map(degree).fillna(0).astype(int)
+    return cast("pd.Series", (source_degree + target_degree).rename("combined_degree"))
 
-async def finalize_relationship():
-    relationships_df = pd.read_parquet("relationships.parquet")
+async def finalize_relationship(graph: Optional[nx.Graph] = None, node_degree_df: Optional[pd.DataFrame] = None):
+    # 必要な列だけを読み込む
+    relationships_df = pd.read_parquet("relationships.parquet", columns=["id", "source", "target", "description", "weight", "text_unit_ids"])
 
-    graph = await create_graph_from_pandas_relationship(relationships_df)
-    node_degrees_df = await compute_node_degrees_from_graph(graph)
+    # グラフと次数が渡されていない場合のみ作成する
+    if node_degree_df is None:
+        if graph is None:
+            graph = await create_graph_from_pandas_relationship(relationships_df)
+        node_degree_df = await compute_node_degrees_from_graph(graph)
 
     final_relationships = relationships_df.drop_duplicates(subset=["source", "target"])
 
     final_relationships["combined_degree"] = compute_edge_combined_degree(
         final_relationships,
-        node_degrees_df,
+        node_degree_df,
         node_name_column="title",
         node_degree_column="degree",
         edge_source_column="source",
@@ -773,7 +1012,7 @@ async def finalize_relationship():
     )
 
     append_to_parquet(final_relationships, "final_relationships.parquet")
-    print("Finalized relationships complete.")
+    logger.info("Finalized relationships complete.")
 
 def compute_leiden_communities(graph: nx.Graph) -> Tuple[Dict[int, Dict[str, int]], Dict[int, int]]:
     """
@@ -815,7 +1054,8 @@ def compute_leiden_communities(graph: nx.Graph) -> Tuple[Dict[int, Dict[str, int
     graph = graph.subgraph(largest_component_nodes).copy()
 
     # (3) Leiden法を用いた階層的クラスタリングを実行
-    community_mapping = hierarchical_leiden(graph, max_cluster_size=10, resolution=1.2)
+    # 辺の重み（同じノード間のリレーションの件数）を考慮したモジュラリティでクラスタリングする
+    community_mapping = hierarchical_leiden(graph, max_cluster_size=10, resolution=1.2, weight_attribute="weight")
 
     # クラスタ情報を格納する辞書
     results: Dict[int, Dict[str, int]] = {}  # {レベル: {ノード: クラスタID}}
@@ -835,30 +1075,30 @@ def compute_leiden_communities(graph: nx.Graph) -> Tuple[Dict[int, Dict[str, int
 
 def cluster_graph(community_mapping: dict[int, dict[str, int]],hierarchy:dict[int, int]) -> List[tuple[int, int, int, list[str]]]:
 
-    levels = sorted(community_mapping.keys())
-    clusters: dict[int, dict[int, list[str]]] = {}
-    for level in levels:
-        clusters[level] = {}
-        for node_id, raw_community_id in community_mapping[level].items():
-            if raw_community_id not in clusters[level]:
-                clusters[level][raw_community_id] = []
-            clusters[level][raw_community_id].append(node_id)
-    
-    results = []
-    for level, communities in clusters.items():
-        for cluster_id, nodes in communities.items():
-            results.append((level, cluster_id, hierarchy.get(cluster_id, -1), nodes))
-    return results
+    # (レベル, クラスタID, ノード) の縦持ちのデータフレームにし、groupby でクラスタごとのノードをまとめる
+    levels, cluster_ids, nodes = [], [], []
+    for level, mapping in community_mapping.items():
+        levels.extend([level] * len(mapping))
+        cluster_ids.extend(mapping.values())
+        nodes.extend(mapping.keys())
+    node_df = pd.DataFrame({"level": levels, "cluster": cluster_ids, "node": nodes})
+
+    grouped = node_df.groupby(["level", "cluster"])["node"].agg(list).reset_index()
+    # 親クラスタが存在しない場合は `-1`
+    grouped["parent"] = grouped["cluster"].map(hierarchy).fillna(-1).astype(int)
+    return list(grouped[["level", "cluster", "parent", "node"]].itertuples(index=False, name=None))
 
 
-async def create_community():
-    entities_df = pd.read_parquet("entities.parquet")
-    relationships_df = pd.read_parquet("relationships.parquet")
+async def create_community(graph: Optional[nx.Graph] = None, period: Optional[str] = None):
+    # 必要な列だけを読み込む
+    entities_df = pd.read_parquet("entities.parquet", columns=["id", "title"])
+    relationships_df = pd.read_parquet("relationships.parquet", columns=["id", "source", "target", "text_unit_ids"])
 
     try:
 
-        # networkxのグラフを作成
-        graph = await create_graph_from_pandas_relationship(relationships_df)
+        # networkxのグラフを作成（渡されていない場合のみ）
+        if graph is None:
+            graph = await create_graph_from_pandas_relationship(relationships_df)
 
         # leiden法によってグラフのコミュニティを計算
         community_mapping, hierarchy = compute_leiden_communities(graph)
@@ -878,59 +1118,45 @@ async def create_community():
             entity_ids.groupby("community").agg(entity_ids=("id", list)).reset_index()
             )
 
-        # 最大のコミュニティ階層レベルを取得
-        max_level = community_df["level"].max()
-        all_grouped = pd.DataFrame(
-            columns=["community", "level", "relationship_ids", "text_unit_ids"]
+        # 全レベルのコミュニティをまとめて処理（レベルごとにループせず、結合と集約を 1 回で行う）
+        # (1) `relationships_df` (リレーション情報) を `source` で `community_df` と結合
+        sources = relationships_df.merge(
+            community_df, left_on="source", right_on="title", how="inner"
         )
 
-        # 各レベルのコミュニティを処理
-        for level in range(max_level + 1):
-            # (1) 現在の `level` に属するコミュニティを取得
-            communities_at_level = community_df.loc[community_df["level"] == level]
-
-            # (2) `relationships_df` (リレーション情報) を `source` で `communities_at_level` と結合
-            sources = relationships_df.merge(
-                communities_at_level, left_on="source", right_on="title", how="inner"
-            )
-
-            # (3) `source` の結合結果を `target` で再度 `communities_at_level` と結合
-            targets = sources.merge(
-                communities_at_level, left_on="target", right_on="title", how="inner"
-            )
-
-            # (4) 同じコミュニティに属する `source` と `target` のリレーションのみを抽出
-            matched = targets.loc[targets["community_x"] == targets["community_y"]]
+        # (2) `source` の結合結果を `target` で再度 `community_df` と結合
+        targets = sources.merge(
+            community_df, left_on="target", right_on="title", how="inner"
+        )
 
-            # (5) `text_unit_ids` を展開（1つのセルに複数値がある場合、それぞれを別の行として扱う）
-            text_units = matched.explode("text_unit_ids")
+        # (3) 同じレベルの同じコミュニティに属する `source` と `target` のリレーションのみを抽出
+        matched = targets.loc[
+            (targets["community_x"] == targets["community_y"])
+            & (targets["level_x"] == targets["level_y"])
+        ]
 
-            # (6) `community_x` ごとに `relationship_ids` と `text_unit_ids` を集約
-            grouped = (
-                text_units.groupby(["community_x", "level_x", "parent_x"])
-                .agg(relationship_ids=("id", list), text_unit_ids=("text_unit_ids", list))
-                .reset_index()
-            )
+        # (4) `text_unit_ids` を展開（1つのセルに複数値がある場合、それぞれを別の行として扱う）
+        text_units = matched.explode("text_unit_ids")
 
-            # (7) カラム名を `final_communities` に合わせて変更
-            grouped.rename(
-                columns={
-                    "community_x": "community",
-                    "level_x": "level",
-                    "parent_x": "parent",
-                },
-                inplace=True,
-            )
+        # (5) `community_x` ごとに `relationship_ids` と `text_unit_ids` を集約
+        grouped = (
+            text_units.groupby(["community_x", "level_x", "parent_x"])
+            .agg(relationship_ids=("id", list), text_unit_ids=("text_unit_ids", list))
+            .reset_index()
+        )
 
-            # (8) `all_grouped` に今回のレベルのデータを追加
-            all_grouped = pd.concat([
-                all_grouped,
-                grouped.loc[
-                    :, ["community", "level", "parent", "relationship_ids", "text_unit_ids"]
-                ],
-            ])
+        # (6) カラム名を `final_communities` に合わせて変更
+        grouped.rename(
+            columns={
+                "community_x": "community",
+                "level_x": "level",
+                "parent_x": "parent",
+            },
+            inplace=True,
+        )
+        all_grouped = grouped
 
-        # (9) `relationship_ids` と `text_unit_ids` を `set()` で一意にして並び替え
+        # (7) `relationship_ids` と `text_unit_ids` を `set()` で一意にして並び替え
         all_grouped["relationship_ids"] = all_grouped["relationship_ids"].apply(
             lambda x: sorted(set(x))
         )
@@ -938,28 +1164,28 @@ async def create_community():
             lambda x: sorted(set(x))
         )
 
-        # (10) `entity_ids` を追加して `final_communities` を作成
+        # (8) `entity_ids` を追加して `final_communities` を作成
         final_communities = all_grouped.merge(entity_ids, on="community", how="inner")
 
-        # (11) 各コミュニティにユニークな ID を付与
+        # (9) 各コミュニティにユニークな ID を付与
         final_communities["id"] = [str(uuid.uuid4()) for _ in range(len(final_communities))]
 
-        # (12) `human_readable_id` を `community` の値に設定
+        # (10) `human_readable_id` を `community` の値に設定
         final_communities["human_readable_id"] = final_communities["community"]
 
-        # (13) `title` を `"Community X"` の形式に設定
+        # (11) `title` を `"Community X"` の形式に設定
         final_communities["title"] = "Community " + final_communities["community"].astype(str)
 
-        # (14) `parent` を整数型に変換
+        # (12) `parent` を整数型に変換
         final_communities["parent"] = final_communities["parent"].astype(int)
 
-        # (15) `parent` ごとに `children` をリスト化
+        # (13) `parent` ごとに `children` をリスト化
         parent_grouped = cast(
             "pd.DataFrame",
             final_communities.groupby("parent").agg(children=("community", "unique")),
         )
 
-        # (16) `final_communities` に `children` 情報を追加
+        # (14) `final_communities` に `children` 情報を追加
         final_communities = final_communities.merge(
             parent_grouped,
             left_on="community",
@@ -967,23 +1193,23 @@ async def create_community():
             how="left",
         )
 
-        # (17) `children` が NaN の場合は空リストに変換
+        # (15) `children` が NaN の場合は空リストに変換
         final_communities["children"] = final_communities["children"].apply(
             lambda x: x if isinstance(x, np.ndarray) else []  # type: ignore
         )
 
-        # (18) `period` に現在の日付を設定（ISO-8601形式）
-        final_communities["period"] = datetime.now(timezone.utc).date().isoformat()
+        # (16) `period` に実行日の日付を設定（ISO-8601形式）
+        final_communities["period"] = period or datetime.now(timezone.utc).date().isoformat()
 
-        # (19) `size` を `entity_ids` の数として設定
+        # (17) `size` を `entity_ids` の数として設定
         final_communities["size"] = final_communities.loc[:, "entity_ids"].apply(len)
 
 
     except Exception as e:
-        print(f"Error creating community: {e}")
+        logger.error(f"Error creating community: {e}")
     
     append_to_parquet(final_communities, "final_community.parquet")
-    print("Finalized community complete.")
+    logger.info("Finalized community complete.")
 
 
 community_report_schema = pa.schema([
@@ -1004,86 +1230,110 @@ community_report_schema = pa.schema([
     ("size", pa.int64()),
 ])
 
-def append_community_report_to_parquet(record: dict, file_path: str):
+# レコードごとにスキーマを参照しないよう、列名と型の判定結果はモジュール読み込み時に 1 度だけ求めておく
+_SCHEMA_COLS = community_report_schema.names
+_SCHEMA_TYPE_BY_NAME = {
+    field.name: (
+        "list" if pa.types.is_list(field.type)
+        else "string" if pa.types.is_string(field.type)
+        else "int64" if pa.types.is_int64(field.type)
+        else None
+    )
+    for field in community_report_schema
+}
+
+def to_community_report_row(record: dict) -> Optional[dict]:
+    if record is None or not isinstance(record, dict) or len(record) == 0:
+        logger.warning("Skipping empty or invalid record")
+        return None
+
+    # 型変換（childrenなど）
+    children = record.get("children")
+    if isinstance(children, np.ndarray):
+        record["children"] = [str(c) for c in children.tolist()]
+    elif isinstance(children, list):
+        record["children"] = [str(c) for c in children]
+    elif children is None:
+        record["children"] = []
+    else:
+        record["children"] = [str(children)]
+
+    # スキーマに合わせて型補正
+    row = {}
+    for col in _SCHEMA_COLS:
+        typ = _SCHEMA_TYPE_BY_NAME[col]
+        value = record.get(col)
+        if value is None or (not isinstance(value, list) and pd.isna(value)):
+            value = [] if typ == "list" else None
+        elif typ == "string":
+            value = str(value)
+        elif typ == "int64":
+            value = pd.to_numeric(value, errors="coerce")
+            value = None if pd.isna(value) else int(value)
+        row[col] = value
+    return row
+
+def write_community_report_records(writer: pq.ParquetWriter, rows: List[dict]):
     try:
-        if record is None or not isinstance(record, dict) or len(record) == 0:
-            print("⚠️ Skipping empty or invalid record")
-            return
-
-        # 型変換（childrenなど）
-        children = record.get("children")
-        if isinstance(children, np.ndarray):
-            record["children"] = [str(c) for c in children.tolist()]
-        elif isinstance(children, list):
-            record["children"] = [str(c) for c in children]
-        elif children is None:
-            record["children"] = []
-        else:
-            record["children"] = [str(children)]
-
-        # DataFrame & 型補正
-        df = pd.DataFrame([record])
-        for col in community_report_schema.names:
-            if col not in df.columns:
-                df[col] = None
-            typ = community_report_schema.field(col).type
-            if pa.types.is_string(typ):
-                df[col] = df[col].astype("string")
-            elif pa.types.is_int64(typ):
-                df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
-            elif pa.types.is_list(typ):
-                df[col] = df[col].apply(lambda x: x if isinstance(x, list) else [])
-
-        # 追記保存（append=True）
-        if os.path.exists(file_path):
-            existing_df = pd.read_parquet(file_path)
-            combined_df = pd.concat([existing_df, df], ignore_index=True)
-            combined_df.to_parquet(file_path, index=False)
-        else:
-            df.to_parquet(file_path, index=False)
-
-        print(f"Appended 1 record to {file_path}")
+        # 開いたままのライターに複数件をまとめて 1 つの行グループとして追記する（既存ファイルの読み直しは不要）
+        writer.write_table(pa.Table.from_pylist(rows, schema=community_report_schema))
+        logger.info(f"Appended {len(rows)} community report records")
 
     except Exception as e:
-        print(f"Error writing to {file_path}: {e}")
+        logger.error(f"Error writing community report records: {e}")
+        raise
+
 
+# コミュニティレポートの出力形式（構造化出力で JSON スキーマとしてモデルに渡す）
+class ReportFinding(BaseModel):
+    summary: str
+    explanation: str
+
+class CommunityReportResponse(BaseModel):
+    title: str
+    summary: str
+    findings: List[ReportFinding]
 
 async def create_community_report():
 
     try:
-        entity_df = pd.read_parquet("entities.parquet")
-        relationship_df = pd.read_parquet("relationships.parquet")
-        communities_df = pd.read_parquet("community.parquet")
+        # 必要な列だけを読み込む
+        entity_df = pd.read_parquet("entities.parquet", columns=["id", "title", "description"])
+        relationship_df = pd.read_parquet("relationships.parquet", columns=["id", "source", "target", "description"])
+        communities_df = pd.read_parquet("community.parquet", columns=[
+            "id", "human_readable_id", "community", "level", "parent", "children",
+            "entity_ids", "relationship_ids", "period", "size",
+        ])
 
-        COMMUNITY_REPORT_PROMPT = """
-            以下のテキストから、コミュニティに関する簡潔なレポートを作成してください。
+        # 指示と出力形式は全コミュニティで共通の system メッセージにまとめ、コミュニティごとのテキストだけを user メッセージで渡す
+        COMMUNITY_REPORT_PROMPT = """You are an AI assistant.
+
+            ユーザーから与えられたテキストから、コミュニティに関する簡潔なレポートを作成してください。
             レポートには以下の情報を含めてください：
             - title: コミュニティを代表する短いタイトル
             - summary: コミュニティ内の主要なエンティティと関係性の要約
             - findings: エンティティ間の関係や注目点を簡潔にまとめたリスト（3件程度）
 
-            テキスト: {input_text}
-
             出力は以下の形式でJSONとして返してください：
 
-            {{
+            {
             "title": "コミュニティタイトル",
             "summary": "コミュニティの全体概要（200文字程度）",
             "findings": [
-                {{
+                {
                     "summary": "インサイト1の要約",
                     "explanation": "インサイト1の説明"
-                }},
-                {{
+                },
+                {
                     "summary": "インサイト2の要約",
                     "explanation": "インサイト2の説明"
-                }},
-                {{
+                },
+                {
                     "summary": "インサイト3の要約",
                     "explanation": "インサイト3の説明"
-                }}
+                }
             ]
-            }}
+            }
         """
 
         def build_report_record(community_row, parsed_response: dict, full_content: str) -> dict:
@@ -1099,12 +1349,30 @@ async def create_community_report():
                 "full_content": full_content,
                 "rank": parsed_response.get("rating"),  # ratingがない場合はNoneになる
                 "rating_explanation": parsed_response.get("rating_explanation"),
-                "findings": json.dumps(parsed_response.get("findings", []), ensure_ascii=False, indent=2),
-                "full_content_json": json.dumps(parsed_response, ensure_ascii=False, indent=2),
+                # orjson は UTF-8 をそのまま出力するため ensure_ascii=False と同じ結果になる
+                "findings": orjson.dumps(parsed_response.get("findings", []), option=orjson.OPT_INDENT_2).decode(),
+                "full_content_json": orjson.dumps(parsed_response, option=orjson.OPT_INDENT_2).decode(),
                 "period": community_row.get("period"),
                 "size": community_row.get("size"),
             }
         
+        # プロンプトに埋め込む 1 行分のテキストは、コミュニティごとに作らず全行まとめて 1 度だけ作成する
+        def description_or_default(descriptions: pd.Series) -> pd.Series:
+            return descriptions.fillna("").astype(str).replace("", "No description")
+
+        entity_df["_line"] = (
+            entity_df["id"].astype(str) + "," + entity_df["title"].astype(str) + ","
+            + description_or_default(entity_df["description"])
+        )
+        relationship_df["_line"] = (
+            relationship_df["id"].astype(str) + "," + relationship_df["source"].astype(str) + ","
+            + relationship_df["target"].astype(str) + "," + description_or_default(relationship_df["description"])
+        )
+
+        # id をインデックスにしておき、コミュニティごとの全件走査（isin）をインデックスによるハッシュ引きに置き換える
+        entity_lines = entity_df.set_index("id")["_line"]
+        relationship_lines = relationship_df.set_index("id")["_line"]
+
         async def process_single_community(row):
             try:
                 community_id = row["community"]
@@ -1112,82 +1380,172 @@ async def create_community_report():
                 relationship_ids = row["relationship_ids"]
 
                 # エンティティとリレーションの抽出
-                community_entities = entity_df[entity_df["id"].isin(entity_ids)]
-                community_relationships = relationship_df[relationship_df["id"].isin(relationship_ids)]
+                community_entity_lines = entity_lines.reindex(list(entity_ids)).dropna()
+                community_relationship_lines = relationship_lines.reindex(list(relationship_ids)).dropna()
 
                 # プロンプト構築
                 entity_section = "Entities\n\nid,entity,description\n"
-                entity_section += "\n".join([
-                    f'{e["id"]},{e["title"]},{e["description"] or "No description"}'
-                    for _, e in community_entities.iterrows()
-                ])
+                entity_section += "\n".join(community_entity_lines.values)
 
                 relationship_section = "Relationships\n\nid,source,target,description\n"
-                relationship_section += "\n".join([f'{r["id"]},{r["source"]},{r["target"]},{r["description"] or "No description"}'for _, r in community_relationships.iterrows()])
+                relationship_section += "\n".join(community_relationship_lines.values)
 
                 input_text = f"{entity_section}\n\n{relationship_section}"
 
-                prompt = COMMUNITY_REPORT_PROMPT.replace("{input_text}", input_text)
-
-                response = await async_openai_client.chat.completions.create(
+                response = await parse_chat_completion(
                     model=chat_model,
                     messages=[
-                        {"role": "system", "content": "You are an AI assistant."},
-                        {"role": "user", "content": prompt}
+                        {"role": "system", "content": COMMUNITY_REPORT_PROMPT},
+                        {"role": "user", "content": f"テキスト: {input_text}"}
                     ],
-                    response_format={"type": "json_object"},
+                    response_format=CommunityReportResponse,
                     temperature=0.2,
                 )
 
-                content = response.choices[0].message.content.strip()
-                parsed = json.loads(content)
-                record = build_report_record(row, parsed, content)
+                message = response.choices[0].message
+                if message.parsed is None:
+                    raise ValueError(f"No parsed report returned: {message.refusal}")
+                content = message.content.strip()
+                record = build_report_record(row, message.parsed.model_dump(), content)
                 return record
             
             except Exception as e:
-                print(f"Error processing community {community_id}: {e}")
+                logger.error(f"Error processing community {community_id}: {e}")
                 return None
 
-        tasks = [process_single_community(row) for _, row in communities_df.iterrows()]
-        results = await asyncio.gather(*tasks)
-        for record in results:
-            if record is not None:
-                append_community_report_to_parquet(record, "community_reports.parquet")
-
-        # None を除いて DataFrame に
-        valid_results = [r for r in results if r is not None]
+        # 各コミュニティのレポート生成を並列に行う（同時実行数は chat_semaphore で制限される）
+        # 完了した順に受け取り、write_batch_size 件ずつまとめて書き出す
+        write_batch_size = 64
+        valid_results = []
+        pending_rows = []
+        with pq.ParquetWriter("community_reports.parquet", community_report_schema, compression="zstd") as writer:
+            tasks = [asyncio.create_task(process_single_community(row)) for _, row in communities_df.iterrows()]
+            try:
+                for future in asyncio.as_completed(tasks):
+                    record = await future
+                    if record is None:
+                        continue
+                    valid_results.append(record)
+                    report_row = to_community_report_row(record)
+                    if report_row is not None:
+                        pending_rows.append(report_row)
+                    if len(pending_rows) >= write_batch_size:
+                        write_community_report_records(writer, pending_rows)
+                        pending_rows = []
+                if pending_rows:
+                    write_community_report_records(writer, pending_rows)
+            finally:
+                # 書き出しの失敗で中断した場合は、実行中のレポート生成を取り消してから終了する
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        # None を除いた結果を DataFrame に
         return pd.DataFrame(valid_results)
 
     except Exception as e:
-        print(f"Error creating community report: {e}")
+        logger.error(f"Error creating community report: {e}")
+        raise
 
 
 async def get_embedding(text: str) -> list[float]:
-    res = await async_embedding_client.embeddings.create(
-        model=embedding_model,
-        input=[text]
-    )
-    return res.data[0].embedding
+    return (await embed_many([text]))[0]
+
+# 埋め込みの呼び出し全体で同時実行数を制限する
+embedding_semaphore = asyncio.Semaphore(10)
+
+# 複数のテキストを 1 回のリクエストでベクトル化する（リトライは 1 件ずつではなくバッチ単位で行う）
+@retry(
+    retry=retry_if_exception_type(transient_openai_errors),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+async def embed_batch(batch: List[str]) -> List[list[float]]:
+    async with embedding_semaphore:
+        res = await async_embedding_client.embeddings.create(
+            model=embedding_model,
+            input=batch
+        )
+    # res.data は入力順に対応しているが、念のため index で並べ替える
+    return [d.embedding for d in sorted(res.data, key=lambda d: d.index)]
+
+async def embed_many(texts: List[str], batch_size: int = 256) -> List[list[float]]:
+    # batch_size 件ずつ 1 回のリクエストにまとめ、各バッチを並列にベクトル化する
+    results = await asyncio.gather(*[
+        embed_batch(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)
+    ])
+    # バッチの順に連結することで入力と同じ順序に戻す
+    return [embedding for batch in results for embedding in batch]
+
+# 埋め込みベクトルの次元数
+embedding_dimensions = 1536
 
 def is_valid_embedding(embedding):
-    return (
-        isinstance(embedding, list)
-        and all(isinstance(x, float) and not math.isnan(x) for x in embedding)
-    )
+    # 要素ごとの Python のループではなく、NumPy でまとめて NaN / 無限大を判定する
+    arr = np.asarray(embedding, dtype=np.float32)
+    return arr.ndim == 1 and arr.size == embedding_dimensions and bool(np.isfinite(arr).all())
+
+def validate_documents(documents, label="", embedding_matrix: Optional[np.ndarray] = None):
+    if embedding_matrix is not None:
+        # 埋め込みベクトルの行列が渡された場合は、ドキュメント内のリストから行列を作り直さずにそのまま判定する
+        valid_embedding = np.full(len(documents), embedding_matrix.shape[1] == embedding_dimensions)
+        valid_embedding &= np.isfinite(embedding_matrix).all(axis=1)
+    else:
+        # 埋め込みベクトルは次元数がそろっているものを 1 つの行列にまとめ、全件を 1 回で判定する
+        embeddings = [doc["embedding"] for doc in documents]
+        full_size = np.flatnonzero([len(e) == embedding_dimensions for e in embeddings])
+        valid_embedding = np.zeros(len(documents), dtype=bool)
+        if len(full_size) > 0:
+            matrix = np.asarray([embeddings[i] for i in full_size], dtype=np.float32)
+            valid_embedding[full_size] = np.isfinite(matrix).all(axis=1)
 
-def validate_documents(documents, label=""):
     for i, doc in enumerate(documents):
         if not isinstance(doc["id"], str):
-            print(f"[{label}] id is not string at index {i}: {doc['id']} ({type(doc['id'])})")
+            logger.warning(f"[{label}] id is not string at index {i}: {doc['id']} ({type(doc['id'])})")
         if not isinstance(doc["content"], str):
-            print(f" [{label}] content is not string at index {i}")
-        if not is_valid_embedding(doc["embedding"]):
-            print(f" [{label}] embedding is invalid at index {i}")
+            logger.warning(f"[{label}] content is not string at index {i}")
+        if not valid_embedding[i]:
+            logger.warning(f"[{label}] embedding is invalid at index {i}")
         if "community_ids" in doc:
             if not isinstance(doc["community_ids"], list) or not all(isinstance(cid, str) for cid in doc["community_ids"]):
-                print(f" [{label}] community_ids invalid at index {i}: {doc.get('community_ids')}")
+                logger.warning(f"[{label}] community_ids invalid at index {i}: {doc.get('community_ids')}")
+
+# インデックス管理用のクライアントは 1 度だけ作成し、接続を使い回す
+index_client = SearchIndexClient(endpoint, AzureKeyCredential(api_key))
+
+def find_field(search_index, name):
+    return next((field for field in search_index.fields if field.name == name), None)
+
+def vector_profile_settings(search_index, profile_name):
+    vector_search = search_index.vector_search
+    if vector_search is None:
+        return None
+    profile = next((p for p in vector_search.profiles or [] if p.name == profile_name), None)
+    if profile is None:
+        return None
+    algorithm = next((a for a in vector_search.algorithms or [] if a.name == profile.algorithm_configuration_name), None)
+    metric = getattr(getattr(algorithm, "parameters", None), "metric", None)
+    # 取得したインデックスでは列挙型ではなく文字列として返る場合があるため、値の文字列で比較する
+    metric = str(getattr(metric, "value", metric)).lower()
+    return (metric, profile.compression_name)
+
+def is_compatible_index(existing, expected):
+    existing_embedding, expected_embedding = find_field(existing, "embedding"), find_field(expected, "embedding")
+    if existing_embedding is None:
+        return False
+    # 追加フィールド（community_ids など）は型とフィルター可否まで一致している必要がある
+    for expected_field in expected.fields:
+        existing_field = find_field(existing, expected_field.name)
+        if existing_field is None or existing_field.type != expected_field.type or bool(existing_field.filterable) != bool(expected_field.filterable):
+            return False
+    return (
+        existing_embedding.vector_search_dimensions == expected_embedding.vector_search_dimensions
+        and vector_profile_settings(existing, existing_embedding.vector_search_profile_name)
+            == vector_profile_settings(expected, expected_embedding.vector_search_profile_name)
+    )
 
-def build_index(name, extra_fields=[]):
+def build_index(name, extra_fields=[], compress=False):
     try:
         fields = [
             SimpleField(name="id", type=SearchFieldDataType.String, key=True),
@@ -1196,103 +1554,164 @@ def build_index(name, extra_fields=[]):
                 name="embedding",
                 type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
                 searchable=True,
-                vector_search_dimensions=1536,
+                vector_search_dimensions=embedding_dimensions,
                 vector_search_profile_name="hnsw_profile"
             )
         ] + extra_fields
+        # compress=True の場合は、ベクトルを int8 にスカラー量子化して格納する（検索時は元のベクトルで再ランク付け）
+        compressions = [
+            ScalarQuantizationCompression(
+                compression_name="sq8",
+                rerank_with_original_vectors=True,
+                default_oversampling=10,
+                parameters=ScalarQuantizationParameters(quantized_data_type="int8")
+            )
+        ] if compress else None
         index = SearchIndex(
             name=name,
             fields=fields,
             vector_search=VectorSearch(
                 algorithms=[HnswAlgorithmConfiguration(name="hnsw_algorithm")],
-                profiles=[VectorSearchProfile(name="hnsw_profile", algorithm_configuration_name="hnsw_algorithm")]
+                compressions=compressions,
+                profiles=[
+                    VectorSearchProfile(
+                        name="hnsw_profile",
+                        algorithm_configuration_name="hnsw_algorithm",
+                        compression_name="sq8" if compress else None
+                    )
+                ]
             )
         )
 
-        SearchIndexClient(endpoint, AzureKeyCredential(api_key)).create_or_update_index(index)
-        print(f"Index '{name}' created successfully")
+        try:
+            existing_index = index_client.get_index(name)
+        except ResourceNotFoundError:
+            # 初回実行時はインデックスがまだ存在しない
+            existing_index = None
+
+        # 圧縮設定などベクトルフィールドの定義は既存のフィールドに対して変更できないため、
+        # スキーマが異なる場合は削除して作り直す（ドキュメントは毎回すべて再アップロードする）
+        if existing_index is not None and not is_compatible_index(existing_index, index):
+            logger.warning(f"Index '{name}' has an incompatible schema. Deleting and recreating it.")
+            index_client.delete_index(name)
+
+        index_client.create_or_update_index(index)
+        logger.info(f"Index '{name}' created successfully")
     except Exception as e:
-        print(f"Error creating index {name}: {e}")
+        logger.error(f"Error creating index {name}: {e}")
         raise
 
+async def build_index_async(name, extra_fields=[], compress=False):
+    # 同期の API 呼び出しはスレッドで実行し、イベントループを止めない
+    return await asyncio.to_thread(build_index, name, extra_fields, compress)
+
+async def embed_and_upload(index_name: str, texts: List[str], build_document, extra_fields=[], batch_size: int = 256):
+    """インデックスの作成と埋め込みを並行して行い、埋め込みが完了したバッチから順にアップロードする。"""
+    # インデックスの作成は埋め込みと並行して行う
+    index_task = asyncio.create_task(build_index_async(index_name, extra_fields, compress=True))
+
+    async def embed_slice(start: int):
+        embeddings = await embed_batch(texts[start:start + batch_size])
+        # 埋め込みベクトルは連続した float32 の 2 次元配列として保持し、リストへの変換はドキュメント作成時に 1 行ずつ行う
+        return start, np.asarray(embeddings, dtype=np.float32)
+
+    # リトライしても登録できなかったドキュメントのキー（スキーマの不一致や不正なベクトルなど）
+    failed_keys = []
+
+    def on_error(action):
+        failed_keys.append(action.additional_properties.get("id"))
+
+    try:
+        # バッファ付きの送信クライアントが適切なサイズのバッチへの分割とリトライを行う
+        sender = SearchIndexingBufferedSender(endpoint, index_name, AzureKeyCredential(api_key), on_error=on_error)
+        try:
+            for future in asyncio.as_completed([embed_slice(start) for start in range(0, len(texts), batch_size)]):
+                start, embedding_matrix = await future
+                # 最初のアップロードの前にインデックスの作成完了を待つ
+                await index_task
+                documents = [build_document(start + i, embedding) for i, embedding in enumerate(embedding_matrix)]
+                validate_documents(documents, label=index_name, embedding_matrix=embedding_matrix)
+                await asyncio.to_thread(sender.upload_documents, documents=documents)
+        finally:
+            # 残りのバッファの送信（close 時の flush）もイベントループを止めないよう別スレッドで行う
+            await asyncio.to_thread(sender.close)
+    finally:
+        # テキストが 0 件の場合やエラー時も、インデックスの作成が終わるのを待つ
+        await index_task
+
+    if failed_keys:
+        logger.error(f"[{index_name}] Failed to upload {len(failed_keys)} documents: {failed_keys[:5]}")
+
 async def create_community_report_index():
     try:
         # === グローバル検索用 community_report_index ===
         reports = pd.read_parquet("community_reports.parquet")
 
-        def build_report_text(row):
+        def parse_findings(findings_json) -> list:
+            if not isinstance(findings_json, str):
+                return []
             try:
-                findings = json.loads(row["findings"])
-                f_text = "\n".join(f["summary"] + "。" + f["explanation"] for f in findings)
-            except Exception:
-                f_text = ""
-            return f"{row['title']}\n{row['summary']}\n{f_text}"
+                findings = orjson.loads(findings_json)
+            except orjson.JSONDecodeError:
+                return []
+            return [f for f in findings if isinstance(f, dict)] if isinstance(findings, list) else []
+
+        # findings の JSON は列全体で 1 度だけ解析し、本文はリスト内包表記でまとめて作成する
+        parsed_findings = reports["findings"].map(parse_findings)
+        reports["content"] = [
+            f"{title}\n{summary}\n" + "\n".join(
+                f"{f.get('summary') or ''}。{f.get('explanation') or ''}" for f in findings
+            )
+            for title, summary, findings in zip(reports["title"], reports["summary"], parsed_findings)
+        ]
 
-        reports["content"] = reports.apply(build_report_text, axis=1)
+        report_ids = reports["id"].tolist()
+        report_contents = reports["content"].tolist()
 
-        print("Generating embeddings for community reports...")
-        report_embeddings = await asyncio.gather(*[
-            get_embedding(row["content"]) for _, row in reports.iterrows()
-        ])
-        reports["embedding"] = report_embeddings
-        build_index("community-report-index")
-
-        report_documents = []
-        for _, row in reports.iterrows():
-            doc = {
-                "id": str(row["id"]) if pd.notna(row["id"]) else str(uuid.uuid4()),
-                "content": str(row["content"]),
-                "embedding": [float(x) for x in row["embedding"]] if isinstance(row["embedding"], list) else []
+        def build_report_document(i: int, embedding: np.ndarray) -> dict:
+            return {
+                "id": str(report_ids[i]) if pd.notna(report_ids[i]) else str(uuid.uuid4()),
+                "content": str(report_contents[i]),
+                "embedding": embedding.tolist()
             }
-            report_documents.append(doc)
 
-        validate_documents(report_documents, label="report")
-        SearchClient(endpoint, "community-report-index", AzureKeyCredential(api_key)).upload_documents(report_documents)
-        print("Community report documents uploaded.")
+        logger.info("Generating embeddings for community reports...")
+        await embed_and_upload("community-report-index", report_contents, build_report_document)
+        logger.info("Community report documents uploaded.")
 
     except Exception as e:
-        print(f" Error creating search index: {e}")
-
-# セマフォで並列数制限
-semaphore = asyncio.Semaphore(10)
-
-async def get_embedding_with_retry(text, retries=3, delay=2):
-    for i in range(retries):
-        try:
-            async with semaphore:
-                return await get_embedding(text)
-        except Exception as e:
-            print(f"[Retry {i+1}] Failed to get embedding: {e}")
-            await asyncio.sleep(delay)
-    print("[Error] Failed after retries, returning empty embedding.")
-    return []
+        logger.error(f"Error creating search index: {e}")
 
 async def create_entity_index():
     try:
-        entities = pd.read_parquet("final_entities.parquet")
-        communities = pd.read_parquet("community.parquet")
-
-        # entity_id → community_id のマッピングを作成
-        entity_to_community = {}
-        for _, row in communities.iterrows():
-            for eid in row["entity_ids"]:
-                entity_to_community.setdefault(eid, []).append(str(row["id"]))
+        # 必要な列だけを読み込む
+        entities = pd.read_parquet("final_entities.parquet", columns=["id", "title", "description"])
+        communities = pd.read_parquet("community.parquet", columns=["id", "entity_ids"])
 
-        def build_entity_text(row):
-            return f"{row['title']}\n{row['description'] or ''}"
+        # entity_id → community_id のマッピングを作成（explode で 1 行 1 エンティティに展開して groupby で集約）
+        map_df = communities[["id", "entity_ids"]].explode("entity_ids").dropna(subset=["entity_ids"])
+        map_df["id"] = map_df["id"].astype(str)
+        entity_to_community = map_df.groupby("entity_ids", sort=False)["id"].agg(list).to_dict()
 
-        entities["content"] = entities.apply(build_entity_text, axis=1)
+        entities["content"] = entities["title"].astype(str) + "\n" + entities["description"].fillna("").astype(str)
         
 
-        print("Generating embeddings for entities...")
+        entity_ids = entities["id"].astype(str).tolist()
+        entity_contents = entities["content"].tolist()
 
-        entity_embeddings = await asyncio.gather(*[
-            get_embedding_with_retry(row["content"]) for _, row in entities.iterrows()
-        ])
-        entities["embedding"] = entity_embeddings
+        def build_entity_document(i: int, embedding: np.ndarray) -> dict:
+            return {
+                "id": entity_ids[i],
+                "content": str(entity_contents[i]),
+                "embedding": embedding.tolist(),
+                "community_ids": entity_to_community.get(entity_ids[i], [])
+            }
 
-        build_index(
+        logger.info("Generating embeddings for entities...")
+        await embed_and_upload(
             "entity-index",
+            entity_contents,
+            build_entity_document,
             extra_fields=[
                 SearchField(
                     name="community_ids",
@@ -1301,31 +1720,19 @@ async def create_entity_index():
                 )
             ]
         )
-
-        entity_documents = []
-        for _, row in entities.iterrows():
-            eid = str(row["id"])
-            doc = {
-                "id": eid,
-                "content": str(row["content"]),
-                "embedding": [float(x) for x in row["embedding"]] if isinstance(row["embedding"], list) else [],
-                "community_ids": entity_to_community.get(eid, [])
-            }
-            entity_documents.append(doc)
-
-        validate_documents(entity_documents, label="entity")
-        SearchClient(endpoint, "entity-index", AzureKeyCredential(api_key)).upload_documents(entity_documents)
-        print(" Entity documents uploaded.")
+        logger.info("Entity documents uploaded.")
 
     except Exception as e:
-        print(f"[Fatal Error] create_entity_index failed: {e}")
+        logger.error(f"[Fatal Error] create_entity_index failed: {e}")
         raise
 
+# 検索クライアントは 1 度だけ作成し、検索のたびに HTTP セッションを作り直さないようにする
+search_client_local = SearchClient(endpoint, "entity-index", AzureKeyCredential(api_key))
+search_client_global = SearchClient(endpoint, "community-report-index", AzureKeyCredential(api_key))
+
 async def graph_search(query: str, top_k: int = 5):
-    search_client_local = SearchClient(endpoint, "entity-index", AzureKeyCredential(api_key))
-    search_client_global = SearchClient(endpoint, "community-report-index", AzureKeyCredential(api_key))
 
-    print(f"\nStep 1: Embedding query and searching for relevant entities...")
+    logger.info("Step 1: Embedding query and searching for relevant entities...")
     query_embedding = await get_embedding(query)
 
     # === Step 1: エンティティのベクトル検索 ===
@@ -1337,41 +1744,47 @@ async def graph_search(query: str, top_k: int = 5):
         "profile": "hnsw_profile"
     }
 
-    entity_results = search_client_local.search(
+    # 同期の検索呼び出しはスレッドで実行し、イベントループを止めない
+    entity_results = await asyncio.to_thread(lambda: list(search_client_local.search(
         search_text="",  # ← テキスト検索を無効化
         vector_queries=[entity_vector_query],
         select=["id", "content", "community_ids"],
         top=top_k
-    )
-
-    entity_results = list(entity_results)
+    )))
     if not entity_results:
-        print("No relevant entities found.")
+        logger.info("No relevant entities found.")
         return
 
     for i, res in enumerate(entity_results, 1):
-        print(f"[Entity {i}] {res['content'][:100]}...")
+        logger.info(f"[Entity {i}] {res['content'][:100]}...")
 
     # === Step 2: エンティティから community_id を集約 ===
-    print(f"\nStep 2: Inferring most relevant community_id from entity results...")
-    community_counter = Counter()
-    for res in entity_results:
-        for cid in res.get("community_ids", []):
-            community_counter[cid] += 1
+    logger.info("Step 2: Inferring most relevant community_id from entity results...")
+    community_counter = Counter(chain.from_iterable(res.get("community_ids") or [] for res in entity_results))
 
     if not community_counter:
-        print("No community_id found in entities.")
+        logger.info("No community_id found in entities.")
         return
 
     inferred_community_id, count = community_counter.most_common(1)[0]
-    print(f"Inferred community_id: {inferred_community_id} (appeared {count} times)")
+    logger.info(f"Inferred community_id: {inferred_community_id} (appeared {count} times)")
 
     # === Step 3: エンティティ内容を結合して refined embedding を作成 ===
-    combined_text = " ".join(res["content"] for res in entity_results)
+    # 埋め込みモデルの入力が長くなりすぎないよう、エンティティごとと全体のトークン数に上限を設けて結合する
+    encoding = get_encoding("cl100k_base")
+    pieces = []
+    budget = 6000
+    for res in entity_results:
+        if budget <= 0:
+            break
+        tokens = encoding.encode(res["content"])[:min(1000, budget)]
+        pieces.append(encoding.decode(tokens))
+        budget -= len(tokens)
+    combined_text = " ".join(pieces)
     refined_embedding = await get_embedding(combined_text)
 
     # === Step 4: グローバルな community_report に対して検索 ===
-    print(f"\nStep 3: Searching related community reports based on entity context...")
+    logger.info("Step 3: Searching related community reports based on entity context...")
 
     report_vector_query = {
         "vector": refined_embedding,
@@ -1381,20 +1794,18 @@ async def graph_search(query: str, top_k: int = 5):
         "profile": "hnsw_profile"
     }
 
-    report_results = search_client_global.search(
+    report_results = await asyncio.to_thread(lambda: list(search_client_global.search(
         search_text="",
         vector_queries=[report_vector_query],
         select=["id", "content"],
         top=top_k
-    )
-
-    report_results = list(report_results)
+    )))
     if not report_results:
-        print("No relevant community reports found.")
+        logger.info("No relevant community reports found.")
         return
 
     for i, res in enumerate(report_results, 1):
-        print(f"[Report {i}] {res['content'][:120]}...\n")
+        logger.info(f"[Report {i}] {res['content'][:120]}...")
 
     return query, entity_results, report_results
 
@@ -1417,8 +1828,8 @@ async def generate_answer_from_graph_search(query: str, entities: list, reports:
     """
 
 
-    print("\n[LLM] Generating answer from retrieved context...")
-    response = await async_openai_client.chat.completions.create(
+    logger.info("[LLM] Generating answer from retrieved context...")
+    response = await create_chat_completion(
             model=chat_model,
             messages=[
                 {"role": "system", "content": "You are an AI assistant."},
@@ -1432,6 +1843,9 @@ async def generate_answer_from_graph_search(query: str, entities: list, reports:
 
 
 async def run_pipeline():
+    # パイプライン全体で共通の実行日（ISO-8601形式）
+    period = datetime.now(timezone.utc).date().isoformat()
+
     documents_df = create_documents()
     print("--- Documents ---")
     print(documents_df)
@@ -1446,11 +1860,15 @@ async def run_pipeline():
 
     await extract_graph(text_units_df)
 
-    await finalize_entities()
+    # グラフとノードの次数は 1 度だけ計算し、後続の各ステップで共有する
+    graph = await create_graph_from_pandas_relationship(pd.read_parquet("relationships.parquet", columns=["source", "target"]))
+    node_degree_df = await compute_node_degrees_from_graph(graph)
+
+    await finalize_entities(graph, node_degree_df)
 
-    await finalize_relationship()
+    await finalize_relationship(graph, node_degree_df)
 
-    await create_community()
+    await create_community(graph, period)
 
     await create_community_report()
 
@@ -1464,4 +1882,8 @@ async def run_pipeline():
 
 
 # 実行
-asyncio.run(run_pipeline())
\ No newline at end of file
+try:
+    asyncio.run(run_pipeline())
+finally:
+    # キューに残ったログを出力し切ってから終了する
+    log_listener.stop()
\ No newline at end of file
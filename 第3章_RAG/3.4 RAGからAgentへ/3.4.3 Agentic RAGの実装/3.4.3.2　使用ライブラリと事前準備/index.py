@@ -1,4 +1,4 @@
-import json 
+import orjson 
 import os 
 import pandas as pd 
 from sklearn.metrics.pairwise import cosine_similarity 
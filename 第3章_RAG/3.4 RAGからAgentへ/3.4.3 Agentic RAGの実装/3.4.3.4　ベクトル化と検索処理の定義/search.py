@@ -1,3 +1,5 @@
+import numpy as np
+
 embedding_results = [] 
 for text in db["combined"].tolist(): 
     response = azure_openai_client.embeddings.create( 
@@ -9,17 +11,23 @@ for text in db["combined"].tolist():
 db['embeddings'] = embedding_results 
 db.head() 
 
+# 埋め込みを L2 正規化した float32 の行列として 1 度だけ作成しておく
+embedding_matrix = np.asarray(embedding_results, dtype=np.float32)
+embedding_matrix /= np.linalg.norm(embedding_matrix, axis=1, keepdims=True)
+
 def retrieve_documents(query: str, n=1) -> dict: 
     #クエリをベクトル化 
     query_emb = azure_openai_client.embeddings.create( 
         model=embedding_model, 
         input=[query]
     )
-    #コサイン類似度の計算 
-    similarity_scores = cosine_similarity( 
-        [query_emb.data[0].embedding], db['embeddings'].tolist() 
-    )[0] 
-    # 上位n件を抽出 
-    top_indices = similarity_scores.argsort()[::-1][:n] 
+    query_vector = np.asarray(query_emb.data[0].embedding, dtype=np.float32)
+    query_vector /= np.linalg.norm(query_vector)
+    #コサイン類似度の計算（正規化済みのため行列とベクトルの積のみで計算できる）
+    similarity_scores = embedding_matrix @ query_vector
+    # 上位n件を抽出（全件ソートせず argpartition で上位n件を選んでから並べ替える）
+    n = min(n, len(similarity_scores))
+    top_indices = np.argpartition(-similarity_scores, n - 1)[:n]
+    top_indices = top_indices[np.argsort(-similarity_scores[top_indices])]
     top_matches = db.iloc[top_indices] 
     return {"top_matched_document": top_matches.combined.tolist()}
\ No newline at end of file
@@ -25,11 +25,12 @@ def agentic_search(message: str, preamble: str, verbose: bool = False) -> str:
         tool_calls = response.choices[0].message.tool_calls
         if not tool_calls:
             return response.choices[0].message.content  # ツール呼び出しなしなら終了
-        tool_results = [{"call": tool_call.function.name, "output": functions_map[tool_call.function.name](**json.loads(tool_call.function.arguments))}
+        tool_results = [{"call": tool_call.function.name, "output": functions_map[tool_call.function.name](**orjson.loads(tool_call.function.arguments))}
                         for tool_call in tool_calls]
         chat_history.extend([
             {"role": "assistant", "content": None, "tool_calls": tool_calls},
-            *[{"role": "tool", "tool_call_id": tool_call.id, "content": json.dumps(result["output"])} for tool_call, result in zip(tool_calls, tool_results)]
+            # orjson は日本語を \uXXXX にエスケープせず UTF-8 のまま出力するため、ツール結果のトークン数も少なくなる
+            *[{"role": "tool", "tool_call_id": tool_call.id, "content": orjson.dumps(result["output"]).decode()} for tool_call, result in zip(tool_calls, tool_results)]
         ])
         if verbose:
             print(f"Tool Results: {tool_results}")
@@ -1,8 +1,11 @@
 # --------------------------
 # 1. 必要なライブラリのインポート
 # --------------------------
+import asyncio
+import hashlib
 import os
 from pathlib import Path
+import numpy as np
 import requests
 import pykakasi
 
@@ -11,9 +14,9 @@ from llama_index.core import (
     VectorStoreIndex, 
     SummaryIndex, 
     load_index_from_storage, 
-    StorageContext
+    StorageContext,
+    QueryBundle
 )
-from llama_index.core.objects import ObjectIndex
 from llama_index.core.agent import ReActAgent
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
 from llama_index.agent.openai import OpenAIAgent
@@ -74,7 +77,8 @@ openai_embedding_model = AzureOpenAIEmbedding(
     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
     api_version=os.getenv("OPENAI_API_VERSION"),
     deployment_name=os.getenv("AZURE_OPENAI_EMBEDDING "),
-    model="text-embedding-ada-002"
+    model="text-embedding-ada-002",
+    embed_batch_size=2048,  # 1 リクエストで送る入力数（Azure OpenAI の上限）
 )
 Settings.embed_model = openai_embedding_model
 # --------------------------
@@ -83,39 +87,57 @@ Settings.embed_model = openai_embedding_model
 agents = {}
 query_engines = {}
 
-for wiki_title in wiki_titles:
-    # テキストをノード（小さいチャンク）に分割
-    nodes = temple_docs[wiki_title]
-    
-    # ベクターインデックスの作成
-    vector_index = VectorStoreIndex(nodes)
-    vector_query_engine = vector_index.as_query_engine(llm=Settings.llm)
+# 全寺院のノードをまとめて 1 度だけバッチで埋め込み、各ノードに付与しておく
+# （埋め込み済みのノードは VectorStoreIndex 側で再計算されない）
+all_nodes = [node for wiki_title in wiki_titles for node in temple_docs[wiki_title]]
+embeddings = openai_embedding_model.get_text_embedding_batch(
+    [node.get_content() for node in all_nodes], show_progress=True
+)
+for node, embedding in zip(all_nodes, embeddings):
+    node.embedding = embedding
+
+# 同時に構築する寺院数の上限（Azure OpenAI のレート制限対策）
+build_semaphore = asyncio.Semaphore(8)
+
+async def build_agent(wiki_title):
+    async with build_semaphore:
+        # テキストをノード（小さいチャンク）に分割
+        nodes = temple_docs[wiki_title]
 
-    # サマリーインデックスの作成
-    summary_index = SummaryIndex(nodes)
-    summary_query_engine = summary_index.as_query_engine(llm=Settings.llm)
+        # ベクターインデックスの作成（埋め込みが残っている場合に備えて別スレッドで行い、寺院間で並行させる）
+        vector_index = await asyncio.to_thread(VectorStoreIndex, nodes)
+        vector_query_engine = vector_index.as_query_engine(llm=Settings.llm)
+
+        # サマリーインデックスの作成
+        summary_index = SummaryIndex(nodes)
+        summary_query_engine = summary_index.as_query_engine(llm=Settings.llm)
 
     # クエリエンジンの設定
     query_engine_tools = [
-QueryEngineTool(
-query_engine=vector_query_engine,
-metadata=ToolMetadata(
-name="vector_tool",
-description=f"{wiki_title}の詳細情報検索ツール"
-)
-),
-QueryEngineTool(
-query_engine=summary_query_engine,
-metadata=ToolMetadata(
-name="summary_tool",
-description=f"{wiki_title}の要約ツール"
-)
-)
-]
-
+        QueryEngineTool(
+            query_engine=vector_query_engine,
+            metadata=ToolMetadata(
+                name="vector_tool",
+                description=f"{wiki_title}の詳細情報検索ツール"
+            )
+        ),
+        QueryEngineTool(
+            query_engine=summary_query_engine,
+            metadata=ToolMetadata(
+                name="summary_tool",
+                description=f"{wiki_title}の要約ツール"
+            )
+        )
+    ]
 
     # エージェントの作成
     agent = OpenAIAgent.from_tools(query_engine_tools, llm=Settings.llm, verbose=True)
+    return wiki_title, agent
+
+async def build_agents():
+    return await asyncio.gather(*(build_agent(wiki_title) for wiki_title in wiki_titles))
+
+for wiki_title, agent in asyncio.run(build_agents()):
     agents[wiki_title] = agent
 
 # --------------------------
@@ -126,12 +148,49 @@ all_tools = [
     for wiki_title in wiki_titles
 ]
 
-obj_index = ObjectIndex.from_objects(all_tools, index_cls=VectorStoreIndex)
+# ツール説明の埋め込みを行列として保持し、メモリ上のコサイン類似度で上位のツールを選ぶ
+# 埋め込みはツール説明とモデル名のハッシュをキーにディスクへ保存し、次回以降の実行で再利用する
+class DenseToolRetriever:
+    def __init__(self, tools, embed_model, similarity_top_k=5, cache_dir="storage/tool_embeddings"):
+        self.tools = tools
+        self.embed_model = embed_model
+        self.similarity_top_k = similarity_top_k
+        self.matrix = None
+        # ツール数が上位件数以下なら常に全ツールを返すため、埋め込みは不要
+        if len(tools) > similarity_top_k:
+            descriptions = [tool.metadata.description for tool in tools]
+            key = hashlib.sha256("\n".join([embed_model.model_name, *descriptions]).encode("utf-8")).hexdigest()
+            cache_path = Path(cache_dir) / f"{key}.npy"
+            if cache_path.exists():
+                embeddings = np.load(cache_path)
+            else:
+                embeddings = np.asarray(embed_model.get_text_embedding_batch(descriptions), dtype=np.float32)
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                np.save(cache_path, embeddings)
+            self.matrix = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    def _top_k(self, query_embedding):
+        query = np.asarray(query_embedding, dtype=np.float32)
+        scores = self.matrix @ (query / np.linalg.norm(query))
+        top = np.argpartition(-scores, self.similarity_top_k - 1)[:self.similarity_top_k]
+        return [self.tools[i] for i in top[np.argsort(-scores[top])]]
+
+    def retrieve(self, query):
+        if self.matrix is None:
+            return list(self.tools)
+        query_str = query.query_str if isinstance(query, QueryBundle) else str(query)
+        return self._top_k(self.embed_model.get_query_embedding(query_str))
+
+    async def aretrieve(self, query):
+        if self.matrix is None:
+            return list(self.tools)
+        query_str = query.query_str if isinstance(query, QueryBundle) else str(query)
+        return self._top_k(await self.embed_model.aget_query_embedding(query_str))
 
 top_agent = ReActAgent.from_tools(
     llm=Settings.llm,
     max_iterations=50,
-    tool_retriever=obj_index.as_retriever(similarity_top_k=5),
+    tool_retriever=DenseToolRetriever(all_tools, Settings.embed_model, similarity_top_k=5),
     system_prompt="あなたは日本の寺院に関する質問に対応するAIエージェントです。",
     verbose=True,
 )
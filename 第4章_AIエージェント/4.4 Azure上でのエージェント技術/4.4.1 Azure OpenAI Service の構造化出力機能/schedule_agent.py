@@ -1,45 +1,94 @@
 import os
-import json
 import asyncio
+import hashlib
 import random
+from collections import deque
 import httpx
-import pandas as pd
-import matplotlib.pyplot as plt
+import openai
+import orjson
 from openai import AsyncAzureOpenAI as AzureOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+# ---------------------
+# リトライ設定
+# ---------------------
+# 429 の場合はサーバーが指定する Retry-After 秒だけ待ち、それ以外は指数バックオフで待つ
+def wait_retry_after(retry_state):
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        return float(retry_after)
+    return wait_exponential(multiplier=1, max=60)(retry_state)
+
+# レート制限と一時的な障害（タイムアウト・接続エラー・5xx）のみリトライする
+transient_openai_errors = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+gpt_retry = retry(
+    retry=retry_if_exception_type(transient_openai_errors),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+
+# 同時に実行する GPT 呼び出し数の上限（候補の並列生成・評価がレート制限を超えないようにする）
+gpt_semaphore = asyncio.Semaphore(int(os.environ.get("AZURE_MAX_INFLIGHT", 16)))
 
 # ---------------------
 # OpenAIClientクラス
 # ---------------------
 class OpenAIClient:
-    api_configurations = [
-        {"endpoint": os.environ.get("OPENAI_API_BASE_URL", ""), "api_key": os.environ.get("OPENAI_API_KEY", "")},
-    ]
+    # 接続先の一覧。重複する (endpoint, api_key) は読み込み時に 1 つにまとめ、
+    # タプルにして呼び出し側から書き換えられないようにする
+    api_configurations: tuple = tuple(
+        {"endpoint": endpoint, "api_key": api_key}
+        for endpoint, api_key in dict.fromkeys([
+            (os.environ.get("OPENAI_API_BASE_URL", ""), os.environ.get("OPENAI_API_KEY", "")),
+        ])
+    )
     api_version: str = os.environ.get("OPENAI_API_VERSION", "2023-12-01-preview")
     engine_name_llm: str = os.environ.get("OPENAI_API_GPT4_OMNI_128K_20240806", "")
-    http_client: httpx.Client = httpx.AsyncClient()
+    # 全クライアントで共有する HTTP クライアント（HTTP/2 で 1 接続に多重化し、接続を使い回す。h2 パッケージが必要）
+    http_client: httpx.AsyncClient = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=30),
+        timeout=httpx.Timeout(
+            connect=float(os.environ.get("CONNECT_TIMEOUT", 2.0)),
+            read=float(os.environ.get("READ_TIMEOUT", 20.0)),
+            write=None,
+            pool=None
+        ),
+    )
     max_retries: int = int(os.environ.get("MAX_RETRIES", 3))
+    # (endpoint, api_key) ごとに生成済みのクライアントを保持し、呼び出しのたびに作り直さない
+    _client_cache: dict[tuple[str, str], AzureOpenAI] = {}
+    _cache_lock = asyncio.Lock()
     
     @classmethod
     async def get_openai_client(cls, api_key: str, endpoint: str) -> AzureOpenAI:
         """Class method to get or create an AzureOpenAI client with class-level configuration."""
-        return AzureOpenAI(
-            api_key=api_key,
-            api_version=cls.api_version,
-            azure_endpoint=endpoint,
-            http_client=cls.http_client,
-            timeout=httpx.Timeout(
-                connect=float(os.environ.get("CONNECT_TIMEOUT", 2.0)),
-                read=float(os.environ.get("READ_TIMEOUT", 20.0)),
-                write=None,
-                pool=None
-            ),
-        )
+        key = (endpoint, api_key)
+        async with cls._cache_lock:
+            client = cls._client_cache.get(key)
+            if client is None:
+                client = AzureOpenAI(
+                    api_key=api_key,
+                    api_version=cls.api_version,
+                    azure_endpoint=endpoint,
+                    http_client=cls.http_client,
+                    max_retries=0,  # リトライは gpt_call 側でまとめて行う
+                )
+                cls._client_cache[key] = client
+        return client
 
     async def get_client_with_retries(self) -> AzureOpenAI:
         """Tries to get an OpenAI client using different configurations with retry logic."""
-        # 用意したapi_configurationsリストをランダムシャッフル
-        configurations = self.api_configurations
-        random.shuffle(configurations)
+        # 用意したapi_configurationsをランダムな順序で取り出す（重複なしで、失敗した接続先の次は別の接続先を試す）
+        configurations = random.sample(self.api_configurations, len(self.api_configurations))
 
         for attempt in range(self.max_retries):
             config = configurations[attempt % len(configurations)]
@@ -55,18 +104,25 @@ class OpenAIClient:
         raise Exception("Failed to get OpenAI client after retries.")
 
     # GPT API interaction logic
-    async def gpt_call(self, client, prompt: str, text: str) -> str:
+    @gpt_retry
+    async def gpt_call_text(self, client, prompt: str, text: str, temperature: float = 1.0) -> str:
         # ここでresponse_format={"type": "json_object"}を指定してJsonModeを有効化
-        response = await client.chat.completions.create(
-            model=self.engine_name_llm,
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": text}
-            ]   
-        )
-        # JSONとして返るが、ここでは文字列として返却している
-        return str(response.choices[0].message.content)
+        async with gpt_semaphore:
+            response = await client.chat.completions.create(
+                model=self.engine_name_llm,
+                response_format={"type": "json_object"},
+                temperature=temperature,
+                messages=[
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": text}
+                ]
+            )
+        # JSONの文字列をそのまま返却する
+        return response.choices[0].message.content
+
+    async def gpt_call(self, client, prompt: str, text: str, temperature: float = 1.0) -> dict:
+        # JSONとして返るので、辞書に変換して返却する
+        return orjson.loads(await self.gpt_call_text(client, prompt, text, temperature))
 
 # ---------------------
 # Agent A: ScheduleGenerator
@@ -76,11 +132,9 @@ class ScheduleGenerator:
         self.client = client
         self.constraints = constraints
         self.employee_info = employee_info
-
-    async def generate_schedule(self, text):
-        client = await self.client.get_client_with_retries()  # 有効なclientを取得
         # Promptにスケジュール生成の意図とフォーマットを明示
-        prompt = (
+        # 毎回同じ内容なので 1 度だけ組み立てる（先頭が完全に一致するため、Azure OpenAI のプロンプトキャッシュも効きやすい）
+        self.prompt = (
             "以下の社員情報および制約条件に基づいて、一週間の勤務スケジュールを作成してください。\n"
             f"【社員情報＆希望勤務形態】:\n{self.employee_info}\n"
             f"【制約条件】:\n{self.constraints}\n"
@@ -92,8 +146,11 @@ class ScheduleGenerator:
             "  '鈴木一郎': ['休日', '日勤', '夜勤', ...],\n"
             "}\n"
         )
+
+    async def generate_schedule(self, text, temperature: float = 1.0):
+        client = await self.client.get_client_with_retries()  # 有効なclientを取得
         # Agent Bからのフィードバックなどを textに含めて呼び出す
-        schedule = await self.client.gpt_call(client, prompt, text)
+        schedule = await self.client.gpt_call_text(client, self.prompt, text, temperature)
         return schedule
 
 # ---------------------
@@ -104,24 +161,35 @@ class ScheduleEvaluator:
         self.client = client
         self.constraints = constraints
         self.employee_info = employee_info
-
-    async def evaluate_schedule(self, schedule):
-        client = await self.client.get_client_with_retries()
+        self._eval_cache: dict[str, dict] = {}  # 正規化したスケジュールのハッシュ -> 評価結果
         # スケジュールを評価するためのプロンプト
-        prompt = (
+        # 評価対象のスケジュールはユーザーメッセージで渡し、システムプロンプトは毎回同じ内容にする
+        self.prompt = (
             f"以下の社員情報および制約条件に基づいて、提示された勤務スケジュールの妥当性を評価してください。:\n"
             f"【社員情報】:\n{self.employee_info}\n"
             f"【制約条件】:\n{self.constraints}\n"
-            f"【スケジュール】:\n{schedule}\n"
             "以下の形式で評価結果を返してください。\n"
             "{\n"
             "  'score': 0-100,  // スケジュールが制約をどれだけ満たしているかのスコア\n"
             "  'feedback': 'string'  // 改善のためのフィードバック\n"
             "}"
         )
-        evaluation = await self.client.gpt_call(client, prompt, "")
-        # 文字列として受け取り、json.loads()でPythonの辞書へ変換
-        return json.loads(evaluation)
+
+    async def evaluate_schedule(self, schedule):
+        # 同じ内容のスケジュールは再評価せず、キャッシュした評価結果を返す
+        try:
+            normalized = orjson.dumps(orjson.loads(schedule), option=orjson.OPT_SORT_KEYS)
+        except orjson.JSONDecodeError:
+            normalized = schedule.encode("utf-8")
+        key = hashlib.blake2b(normalized).hexdigest()
+        if key in self._eval_cache:
+            return self._eval_cache[key]
+
+        client = await self.client.get_client_with_retries()
+        # gpt_call が辞書に変換済みの評価結果を返す
+        result = await self.client.gpt_call(client, self.prompt, f"【スケジュール】:\n{schedule}\n")
+        self._eval_cache[key] = result
+        return result
 
 # ---------------------
 # Main system: ScheduleOptimizer
@@ -138,57 +206,95 @@ class ScheduleOptimizer:
     def load_schedule(self):
         """Load the existing schedule from a JSON file if it exists."""
         if os.path.exists(self.schedule_file):
-            with open(self.schedule_file, 'r') as f:
-                return json.load(f)
+            with open(self.schedule_file, 'rb') as f:
+                return orjson.loads(f.read())
         return None
 
     def save_schedule(self, schedule):
         """Save the schedule to a JSON file."""
-        with open(self.schedule_file, 'w') as f:
-            json.dump(schedule, f, indent=4)
+        with open(self.schedule_file, 'wb') as f:
+            f.write(orjson.dumps(schedule, option=orjson.OPT_INDENT_2))
 
-    async def optimize_schedule(self, initial_text: str, expected_score: int = 90, max_iterations=5):
+    async def optimize_schedule(self, initial_text: str, expected_score: int = 90, max_iterations=5, num_candidates: int = 4):
         # 既存のスケジュールがあればロードして初期テキストを更新
         existing_schedule = self.load_schedule()
         if existing_schedule:
             print("Existing schedule found. Using as seed for optimization.")
-            initial_text = json.dumps(existing_schedule)
+            initial_text = orjson.dumps(existing_schedule).decode()
         else:
             print("No existing schedule found. Generating a new one.")
 
-        feedback_list = []  # フィードバックの履歴
+        feedback_list = deque(maxlen=2)  # フィードバックの履歴（直近2件のみ保持し、古いものは自動で捨てる）
         best_score = -1
         best_schedule = None
 
-        for iteration in range(max_iterations):
-            print(f"Iteration {iteration + 1}:")
-            # Agent Aでスケジュールを生成
-            schedule = await self.schedule_generator.generate_schedule(initial_text)
-            print(f"Generated Schedule:\n{schedule}\n")
-
-            # Agent Bで評価
-            evaluation = await self.schedule_evaluator.evaluate_schedule(schedule)
-            print(f"Evaluation and Suggestions:\n{evaluation['feedback']}\n")
-
-            score = evaluation.get('score', 0)
-            print(f"Score: {score}")
-
-            if score > best_score:
-                best_score = score
-                best_schedule = schedule
-                print("New best schedule found with higher score.")
-
-            if score >= expected_score:
-                print("Optimized schedule found.")
-                self.save_schedule(best_schedule)
-                break
-            else:
-                print("Revising the schedule based on feedback...\n")
-                feedback_list.append(evaluation['feedback'])
-                if len(feedback_list) > 2:
-                    feedback_list.pop(0)
-                
-                initial_text = "\n".join(feedback_list)
+        # Agent A（生成）と Agent B（評価）をパイプライン化する。
+        # 評価中に次の候補の生成を進め、生成には最新のフィードバックを使う
+        candidates = asyncio.Queue()
+        stop = asyncio.Event()
+        # 生成の開始枠。評価中のバッチに加えて先行して生成できるのは 1 バッチまでとし、
+        # 評価側はフィードバックを反映してから枠を返す（古いフィードバックで何バッチも先行させない）
+        generation_slots = asyncio.Semaphore(2)
+
+        async def produce():
+            try:
+                for iteration in range(max_iterations):
+                    await generation_slots.acquire()
+                    if stop.is_set():
+                        break
+                    # Agent Aでスケジュール候補を並行して複数生成（温度を変えて候補が重複しにくいようにする）
+                    # 温度は候補数によらず 0.7〜1.3 の範囲に均等に割り振る（API の上限 2.0 を超えないようにする）
+                    schedules = await asyncio.gather(*[
+                        self.schedule_generator.generate_schedule(initial_text, temperature=0.7 + 0.6 * k / max(num_candidates - 1, 1))
+                        for k in range(num_candidates)
+                    ])
+                    await candidates.put((iteration, schedules))
+                await candidates.put(None)  # 生成の終了を通知
+            except Exception as e:
+                await candidates.put(e)  # 生成側のエラーは評価側で送出する
+
+        producer = asyncio.create_task(produce())
+        try:
+            while (item := await candidates.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                iteration, schedules = item
+                print(f"Iteration {iteration + 1}:")
+
+                # Agent Bで全候補を並行して評価し、最もスコアの高い候補を採用
+                evaluations = await asyncio.gather(*[
+                    self.schedule_evaluator.evaluate_schedule(schedule) for schedule in schedules
+                ])
+                schedule, evaluation = max(
+                    zip(schedules, evaluations), key=lambda pair: pair[1].get('score', 0)
+                )
+                print(f"Generated Schedule:\n{schedule}\n")
+                print(f"Evaluation and Suggestions:\n{evaluation['feedback']}\n")
+
+                score = evaluation.get('score', 0)
+                print(f"Score: {score}")
+
+                if score > best_score:
+                    best_score = score
+                    best_schedule = schedule
+                    print("New best schedule found with higher score.")
+
+                if score >= expected_score:
+                    print("Optimized schedule found.")
+                    self.save_schedule(best_schedule)
+                    stop.set()
+                    break
+                else:
+                    print("Revising the schedule based on feedback...\n")
+                    feedback_list.append(evaluation['feedback'])
+
+                    initial_text = "\n".join(feedback_list)
+                    # フィードバックを反映したので、次のバッチの生成を許可する
+                    generation_slots.release()
+        finally:
+            # 目標スコアに達した場合などは、先行して生成中の候補を破棄する
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
 
         if best_schedule:
             self.save_schedule(best_schedule)
@@ -197,8 +303,10 @@ class ScheduleOptimizer:
 
     def visualize_schedule(self, schedule: str):
         """Convert the final schedule (in JSON string format) to a DataFrame and plot it."""
+        # 可視化するときだけ必要なため、ここで読み込む（起動時間とメモリを抑える）
+        import pandas as pd
         try:
-            schedule_dict = json.loads(schedule)
+            schedule_dict = orjson.loads(schedule)
             df = pd.DataFrame(schedule_dict)
             plot_schedule(df)
         except ValueError as e:
@@ -208,6 +316,8 @@ class ScheduleOptimizer:
 # スケジュール可視化用の関数
 # ---------------------
 def plot_schedule(df):
+    import matplotlib.pyplot as plt
+    import numpy as np
     fig, ax = plt.subplots(figsize=(10, 6))
     ax.axis('tight')
     ax.axis('off')
@@ -218,17 +328,14 @@ def plot_schedule(df):
     table.set_fontsize(10)
     table.scale(1.2, 1.2)
 
-    # 各シフトによって色分けを行う例
-    for i in range(len(df)):
-        for j in range(1, len(df.columns)):
-            if df.iloc[i, j] == 'Off':
-                table[(i+1, j)].set_facecolor('#FFFF99')
-            elif df.iloc[i, j] == 'Night':
-                table[(i+1, j)].set_facecolor('#556B2F')
-            elif df.iloc[i, j] == 'Afternoon':
-                table[(i+1, j)].set_facecolor('#C0C0C0')
-            elif df.iloc[i, j] == 'Morning':
-                table[(i+1, j)].set_facecolor('#87CEEB')
+    # 各シフトによって色分けを行う例（シフトごとに一致するセルをまとめて求める。先頭列は日付なので除く）
+    color_map = {'Off': '#FFFF99', 'Night': '#556B2F', 'Afternoon': '#C0C0C0', 'Morning': '#87CEEB'}
+    values = df.values
+    for shift, color in color_map.items():
+        for i, j in np.argwhere(values == shift):
+            if j == 0:
+                continue
+            table[(int(i) + 1, int(j))].set_facecolor(color)
 
     plt.title('Employee Schedule', fontsize=16)
     plt.show()
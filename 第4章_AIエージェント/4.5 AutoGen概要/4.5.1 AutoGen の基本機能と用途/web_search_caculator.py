@@ -1,6 +1,6 @@
 import os
 import asyncio
-import requests
+import httpx
 from dotenv import load_dotenv
 
 from autogen_agentchat.agents import AssistantAgent, UserProxyAgent
@@ -39,11 +39,17 @@ async def divide(a: float, b: float) -> str:
 AZURE_BING_API_KEY = os.environ.get("AZURE_BING_API_KEY", "")
 AZURE_BING_ENDPOINT = "https://api.bing.microsoft.com/v7.0/search"
 
+# 検索用の非同期 HTTP クライアント（接続を使い回し、検索中もイベントループを止めない。http2 には h2 パッケージが必要）
+bing_client = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    headers={"Ocp-Apim-Subscription-Key": AZURE_BING_API_KEY},
+)
+
 async def web_search(query: str) -> str:
-    headers = {"Ocp-Apim-Subscription-Key": AZURE_BING_API_KEY}
     params = {"q": query, "count": 20, "mkt": "ja-JP", "setLang": "JA"}
     try:
-        res = requests.get(AZURE_BING_ENDPOINT, headers=headers, params=params)
+        res = await bing_client.get(AZURE_BING_ENDPOINT, params=params)
         res.raise_for_status()
         data = res.json()
         items = data.get("webPages", {}).get("value", [])
@@ -51,6 +57,11 @@ async def web_search(query: str) -> str:
     except Exception as e:
         return f"検索エラー: {e}"
 
+async def web_search_batch(queries: list[str]) -> str:
+    # 複数の検索を同時に行い、クエリごとの見出しを付けて結果をまとめる
+    results = await asyncio.gather(*[web_search(query) for query in queries])
+    return "\n\n".join([f"## {query}\n{result}" for query, result in zip(queries, results)])
+
 # --- 各エージェント定義 ---
 calculator_agent = AssistantAgent(
     name="calculator_agent",
@@ -64,8 +75,8 @@ search_agent = AssistantAgent(
     name="search_agent",
     model_client=model_client,
     description="Web検索の専門家で、外部情報を収集して他のエージェントをサポートします。",
-    system_message="あなたはインターネット検索専門家です。ツール 'web_search' を使って外部情報を検索し、適切に要約して提供してください。完了したら [Stop] を返してください。",
-    tools=[web_search],
+    system_message="あなたはインターネット検索専門家です。ツール 'web_search' を使って外部情報を検索し、適切に要約して提供してください。調べたい項目が複数ある場合は 'web_search_batch' でまとめて検索してください。完了したら [Stop] を返してください。",
+    tools=[web_search, web_search_batch],
 )
 
 
@@ -77,8 +88,11 @@ async def main():
         max_turns=8,
     )
 
-    stream = chat.run_stream(task="三人でスカイツリー天望デッキに行きたいです。合計でいくらかかりますか？")
-    await Console(stream)
+    try:
+        stream = chat.run_stream(task="三人でスカイツリー天望デッキに行きたいです。合計でいくらかかりますか？")
+        await Console(stream)
+    finally:
+        await bing_client.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -3,7 +3,6 @@
 import os
 import asyncio
 # サードパーティライブラリ
-import pandas as pd
 from dotenv import load_dotenv
 from langchain_experimental.tools.python.tool import PythonAstREPLTool
 from autogen_agentchat.agents import AssistantAgent
@@ -26,12 +25,17 @@ model_client = AzureOpenAIChatCompletionClient(
     api_key=os.environ.get("OPENAI_API_KEY", "")
 )
 
-# LangChain ツールの定義：Pandasデータフレーム（Titanicデータ）を扱える Python 実行環境を提供
-# TODO: 実際のCSVファイルパスに置き換えてください
-df = pd.read_csv("<YOUR_PATH>/titanic.csv")
-tool = LangChainToolAdapter(PythonAstREPLTool(locals={"df": df}))
-
 async def main() -> None:
+    # pandas の読み込みと CSV の読み込みは実行時まで遅らせる（インポートしただけでは読み込まない）
+    import pandas as pd
+
+    # LangChain ツールの定義：Pandasデータフレーム（Titanicデータ）を扱える Python 実行環境を提供
+    # TODO: 実際のCSVファイルパスに置き換えてください
+    # pyarrow エンジンで高速に読み込み、列は Arrow 形式で保持する。値の種類が少ない列はカテゴリ型にしてメモリを抑える
+    df = pd.read_csv("<YOUR_PATH>/titanic.csv", engine="pyarrow", dtype_backend="pyarrow")
+    df = df.astype({"Sex": "category", "Embarked": "category"})
+    tool = LangChainToolAdapter(PythonAstREPLTool(locals={"df": df}))
+
     # エージェントの定義：データ分析タスクに対応する専門家エージェント
     agent = AssistantAgent(
         name="agent",
@@ -9,6 +9,9 @@ def main():
     #　Foundry Local Serviceの起動／ロードを行う
     manager = FoundryLocalManager(alias)
 
+    #　使用するモデルIDは起動時に1度だけ取得し、呼び出しのたびに問い合わせない
+    model_id = manager.get_model_info(alias).id
+
     #　OpenAI Python SDKを用いて生成AIモデルと対話する
     #　base_urlにmanager.endpointと設定することでFoundry Local Serviceを使用
     #　ローカル使用においては、APIキーは必要ありません
@@ -22,7 +25,7 @@ def main():
     user_input = input()
 
     stream = client.chat.completions.create(
-        model=manager.get_model_info(alias).id,
+        model=model_id,
         messages=[{"role": "user", "content": user_input}],
         stream=True,
     )